@@ -1,4 +1,5 @@
 import sys
+import signal
 from time import sleep, time
 import argparse
 import requests
@@ -8,7 +9,9 @@ from electroncash.address import Address
 from electroncash.bitcoin import deserialize_privkey, regenerate_key
 from electroncash.networks import NetworkConstants
 from electroncash_plugins.shuffle.client import ProtocolThread
-from electroncash_plugins.shuffle.coin import Coin
+from electroncash_plugins.shuffle.coin import Coin, UnspentWatcher, SigningContext, ServerBroadcast
+from electroncash_plugins.shuffle.tracing import Tracer
+from electroncash_plugins.shuffle.events import EventKind, Level, LogEvent
 from electroncash.storage import WalletStorage
 from electroncash.wallet import Wallet
 
@@ -26,6 +29,13 @@ def parse_args():
     parser.add_argument("-W", "--wallet", help="wallet", type=str, required=True)
     parser.add_argument("--password", help="wallet password", type=str, default ="")
     parser.add_argument("-T", "--period", help="period for checking the server in minutes", type=int, default=10)
+    parser.add_argument("--trace", help="file for the trace events of rounds (JSON Lines)", type=str, default=None)
+    parser.add_argument("--self-verify", help="policy of checking own signatures",
+                        choices=sorted(SigningContext.POLICIES), default="always")
+    parser.add_argument("--broadcast-server", help="additional server for broadcasting of shuffle transactions (host:port:s), can be repeated",
+                        action="append", dest="broadcast_servers", default=[])
+    parser.add_argument("--profile", help="directory for sampled stacks of rounds, SIGUSR1 toggles profiling", type=str, default=None)
+    parser.add_argument("--profile-interval", help="sampling interval of the profiler in milliseconds", type=float, default=5)
     # test_params = "--testnet -P 33333 -S localhost -I 5000 -W plugins/shuffle/wallet/test_wallet --password testwallet -L 2".split()
     return parser.parse_args()
 
@@ -43,20 +53,31 @@ def is_protocol_done(pThread):
 
 class SimpleLogger(object):
 
-    def __init__(self):
+    def __init__(self, level=Level.INFO):
         self.pThread = None
+        self.level = level
 
     def send(self, message):
-        print("[CashShuffle Bot] {}".format(message))
-        if message.startswith("Error"):
+        event = LogEvent.of(message)
+        if event.level < self.level:
+            return
+        print("[CashShuffle Bot] {}".format(event))
+        if event.kind == EventKind.ERROR:
             self.pThread.done.set()
-        elif message.startswith("Blame"):
-            if "insufficient" in message:
-                pass
-            elif "wrong hash" in message:
-                pass
-            else:
-                self.pThread.done.set()
+        elif event.kind == EventKind.BLAME and not event.fields.get('recoverable'):
+            self.pThread.done.set()
+
+def toggle_profiling(signum, frame):
+    "SIGUSR1 handler. Switches profiling of running and next rounds on and off"
+    profiling['enabled'] = not profiling['enabled']
+    for pThread in running:
+        if not pThread.is_alive():
+            continue
+        if profiling['enabled']:
+            pThread.start_profiling(profiling['directory'])
+        else:
+            pThread.stop_profiling()
+    basic_logger.send("[CashShuffle Bot] profiling is {}".format("on" if profiling['enabled'] else "off"))
 
 def job():
     job_start_time = time()
@@ -76,6 +97,10 @@ def job():
                    pool.get("members", 0) >= args.limit]
         # Select unspent outputs in the wallet
         utxos = wallet.get_utxos(exclude_frozen=True, confirmed_only=False)
+        # Keep the index of the wallet coins fresh through the subscriptions,
+        # addresses without coins in the wallet are not watched anymore
+        watcher.watch_only([Address.to_string(utxo['address'], Address.FMT_LEGACY) for utxo in utxos],
+                           wait=True)
         # Select fresh inputs
         fresh_outputs = wallet.get_unused_addresses()
         if len(members) == 0:
@@ -91,7 +116,7 @@ def job():
             for good_utxo in good_utxos:
                 addr = Address.to_string(good_utxo['address'], Address.FMT_LEGACY)
                 try:
-                    first_utxo = coin.get_first_sufficient_utxo(addr, amount)
+                    first_utxo = watcher.get_first_sufficient_utxo(addr, amount)
                     if first_utxo:
                         address = {}
                         address.update({"input_address": good_utxo['address']})
@@ -117,10 +142,15 @@ def job():
                     new_addr = address["shuffle_address"]
                     change = address["change_address"]
                     logger = SimpleLogger()
-                    pThread = (ProtocolThread(host, port, network, amount, fee, sk, pubk, new_addr, change, logger=logger, ssl=ssl))
+                    pThread = (ProtocolThread(host, port, network, amount, fee, sk, pubk, new_addr, change, logger=logger, ssl=ssl, tracer=tracer,
+                                              broadcast_networks=broadcast_networks,
+                                              self_verify=args.self_verify,
+                                              profile=profiling['directory'] if profiling['enabled'] else None,
+                                              profile_interval=args.profile_interval / 1000))
                     logger.pThread = pThread
                     pThreads.append(pThread)
         # start Threads
+        running[:] = pThreads
         for pThread in pThreads:
             pThread.start()
         done = False
@@ -132,6 +162,11 @@ def job():
                 done = True
         for pThread in pThreads:
             pThread.join()
+        running[:] = []
+        # coins of the rounds are spent or will be looked up again by the next job
+        watcher.unwatch([Address.to_string(address["input_address"], Address.FMT_LEGACY)
+                         for member in members for address in member.get("addresses", [])])
+        basic_logger.send("[CashShuffle Bot] UTXO cache {}".format(coin.cache.stats()))
     else:
         basic_logger.send("[CashShuffle Bot] Nobody in the pools")
 
@@ -152,15 +187,23 @@ if args.testnet:
     config = SimpleConfig({'server':"bch0.kister.net:51002:s"})
 network = Network(config)
 network.start()
+# extra servers get the transaction through the short connections, not the own networks
+broadcast_networks = [ServerBroadcast(server) for server in args.broadcast_servers]
 wallet = Wallet(storage)
 wallet.start_threads(network)
 coin = Coin(network)
+watcher = UnspentWatcher(coin)
 # # setup server
 port = args.port
 host = args.server
 stat_port = args.stat_port
 ssl = args.ssl
 fee = args.fee
+tracer = Tracer(sink=args.trace) if args.trace else None
+profiling = {'enabled': args.profile is not None, 'directory': args.profile or 'profiles'}
+running = []
+if hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1, toggle_profiling)
 secured = ("s" if ssl else "")
 stat_endpoint = "http{}://{}:{}/stats".format(secured, host, stat_port)
 
@@ -1,4 +1,6 @@
+import os
 import time
+import itertools
 import threading
 from .coin import Coin
 from .crypto import Crypto
@@ -6,6 +8,11 @@ from .messages import Messages
 from .commutator_thread import Commutator, Channel, ChannelWithPrint
 from .phase import Phase
 from .coin_shuffle import Round
+from .events import EventKind, LogEvent
+from .profiler import SamplingProfiler
+
+# numbers profile files of the process, rounds started in the same millisecond get different names
+profile_numbers = itertools.count(1)
 
 class ProtocolThread(threading.Thread):
     """
@@ -13,7 +20,9 @@ class ProtocolThread(threading.Thread):
     """
     def __init__(self, host, port, network,
                  amount, fee, sk, pubk,
-                 addr_new, change, logger=None, ssl=False):
+                 addr_new, change, logger=None, ssl=False, tracer=None,
+                 profile=None, profile_interval=0.005, broadcast_networks=None,
+                 self_verify='always'):
 
         threading.Thread.__init__(self)
         self.host = host
@@ -40,9 +49,20 @@ class ProtocolThread(threading.Thread):
         self.deamon = True
         self.protocol = None
         self.network = network
+        # other servers to send the final transaction to
+        self.broadcast_networks = broadcast_networks
+        # policy of checking own signatures, see SigningContext
+        self.self_verify = self_verify
+        self.coin = None
+        self.tracer = tracer
         self.tx = None
         self.execution_thread = None
         self.done = threading.Event()
+        # directory for collapsed stacks of the round, None switches the profiler off
+        self.profile = profile
+        self.profile_interval = profile_interval
+        self.profiler = None
+        self.profiler_lock = threading.Lock()
 
     def not_time_to_die(func):
         "Check if 'done' event appear"
@@ -64,7 +84,8 @@ class ProtocolThread(threading.Thread):
         self.session = self.messages.packets.packet[-1].packet.session
         self.number = self.messages.packets.packet[-1].packet.number
         if self.session != '':
-            self.logger.send("Player "  + str(self.number)+" get session number.\n")
+            self.logger.send(LogEvent(EventKind.PROGRESS, "Player {number} get session number.\n",
+                                      number=self.number))
 
     @not_time_to_die
     def wait_for_announcment(self):
@@ -84,13 +105,16 @@ class ProtocolThread(threading.Thread):
                 self.number_of_players = self.messages.get_number()
                 break
             else:
-                self.logger.send("Player " + str(self.messages.get_number()) + " joined the pool!")
+                self.logger.send(LogEvent(EventKind.PROGRESS, "Player {number} joined the pool!",
+                                          number=self.messages.get_number()))
 
     @not_time_to_die
     def share_the_key(self):
         "This method shares the verification keys among the players in the pool"
-        self.logger.send("Player " + str(self.number) + " is about to share verification key with "
-                         + str(self.number_of_players) +" players.\n")
+        self.logger.send(LogEvent(EventKind.PROGRESS,
+                                  "Player {number} is about to share verification key with "
+                                  "{players} players.\n",
+                                  number=self.number, players=self.number_of_players))
         #Share the keys
         self.messages.clear_packets()
         self.messages.packets.packet.add()
@@ -110,16 +134,33 @@ class ProtocolThread(threading.Thread):
         self.players = {packet.packet.number:str(packet.packet.from_key.key)
                         for packet in self.messages.packets.packet}
         if self.players:
-            self.logger.send('Player ' +str(self.number)+ " get " + str(len(self.players))+".\n")
+            self.logger.send(LogEvent(EventKind.PROGRESS, "Player {number} get {players}.\n",
+                                      number=self.number, players=len(self.players)))
         #check if all keys are different
         if len(set(self.players.values())) is not self.number_of_players:
-            self.logger.send('Error: The same keys appears!')
+            self.logger.send(LogEvent(EventKind.ERROR, 'Error: The same keys appears!'))
             self.done.set()
+        else:
+            self.prefetch_unspent()
+
+    def make_coin(self):
+        "Makes the Coin object of the round"
+        return Coin(self.network, self_verify=self.self_verify,
+                    broadcast_networks=self.broadcast_networks)
+
+    def prefetch_unspent(self):
+        "This method starts the lookups of players coins while the round is prepared"
+        self.coin = self.make_coin()
+        try:
+            self.coin.prefetch_unspent([self.coin.address(vk) for vk in self.players.values()])
+        except Exception:
+            # players keys are checked by the round itself
+            pass
 
     @not_time_to_die
     def start_protocol(self):
         "This method starts the protocol thread"
-        coin = Coin(self.network)
+        coin = self.coin if self.coin else self.make_coin()
         crypto = Crypto()
         self.messages.clear_packets()
         begin_phase = Phase('Announcement')
@@ -139,39 +180,83 @@ class ProtocolThread(threading.Thread):
             self.vk,
             self.players,
             self.addr_new,
-            self.change)
+            self.change,
+            tracer=self.tracer)
         self.execution_thread = threading.Thread(target=self.protocol.protocol_loop)
         self.execution_thread.start()
         self.done.wait()
         self.execution_thread.join()
 
 
+    def profiled_threads(self):
+        "threads of the round sampled by the profiler"
+        return {'protocol': self,
+                'commutator': self.commutator,
+                'round': self.execution_thread}
+
+    def start_profiling(self, directory=None, interval=None):
+        """
+        Starts sampling stacks of the round threads.
+        It can be called from other threads, e.g. from the signal handler
+        """
+        with self.profiler_lock:
+            if self.profiler is None:
+                self.profile = directory or self.profile or '.'
+                self.profiler = SamplingProfiler(self.profiled_threads,
+                                                 interval or self.profile_interval).start()
+            return self.profiler
+
+    def stop_profiling(self):
+        """
+        Stops the profiler and writes collapsed stacks to the profile directory.
+        Returns the path of the file or None if the profiler is not running
+        """
+        with self.profiler_lock:
+            profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return None
+        profiler.stop()
+        name = "round-{}.{:03d}-{}-{}.collapsed".format(time.strftime("%Y%m%d-%H%M%S",
+                                                                     time.localtime(profiler.started)),
+                                                       int(profiler.started * 1000) % 1000,
+                                                       str(self.vk)[:16], next(profile_numbers))
+        path = profiler.write(os.path.join(self.profile, name))
+        self.logger.send(LogEvent(EventKind.MESSAGE, "Player {number} wrote {samples} samples to {path}",
+                                  number=self.number, samples=profiler.samples, path=path))
+        return path
+
     def run(self):
         "this method trying to run the round and catch possible problems with it"
+        if self.profile:
+            self.start_profiling()
         try:
-            self.commutator.connect(self.host, self.port)
-            self.commutator.start()
-        except:
-            self.logger.send("Error: cannot connect to server")
-        try:
-            self.register_on_the_pool()
-        except:
-            self.logger.send("Error: cannot register on the pool")
-        try:
-            self.wait_for_announcment()
-        except:
-            self.logger.send("Error: cannot complete the pool")
-        try:
-            self.share_the_key()
-        except:
-            self.logger.send("Error: cannot share the keys")
-        try:
-            self.gather_the_keys()
-        except:
-            self.logger.send("Error: cannot gather the keys")
-        self.start_protocol()
-        if self.commutator.is_alive():
-            self.commutator.join()
+            try:
+                self.commutator.connect(self.host, self.port)
+                self.commutator.start()
+            except:
+                self.logger.send(LogEvent(EventKind.ERROR, "Error: cannot connect to server"))
+            try:
+                self.register_on_the_pool()
+            except:
+                self.logger.send(LogEvent(EventKind.ERROR, "Error: cannot register on the pool"))
+            try:
+                self.wait_for_announcment()
+            except:
+                self.logger.send(LogEvent(EventKind.ERROR, "Error: cannot complete the pool"))
+            try:
+                self.share_the_key()
+            except:
+                self.logger.send(LogEvent(EventKind.ERROR, "Error: cannot share the keys"))
+            try:
+                self.gather_the_keys()
+            except:
+                self.logger.send(LogEvent(EventKind.ERROR, "Error: cannot gather the keys"))
+            self.start_protocol()
+            if self.commutator.is_alive():
+                self.commutator.join()
+        finally:
+            # the profile of a failed round is the most interesting one
+            self.stop_profiling()
 
 
     def stop(self):
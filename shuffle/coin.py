@@ -1,20 +1,637 @@
+import copy
+import json
+import time
+import random
+import socket
+import ssl
 import hashlib
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from electroncash.bitcoin import (
     bfh, bh2u, MySigningKey, MyVerifyingKey, SECP256k1,
-    generator_secp256k1, point_to_ser, public_key_to_p2pkh, Hash,
+    point_to_ser, ser_to_point, public_key_to_p2pkh, Hash,
     pubkey_from_signature, msg_magic, TYPE_ADDRESS)
-from electroncash.transaction import Transaction, int_to_hex
+from electroncash.transaction import Transaction, int_to_hex, var_int
 from electroncash.address import Address
 import ecdsa
+from .tracing import null_counters
+
+class UnspentCache(object):
+    """
+    Process wide cache of 'blockchain.address.listunspent' responses.
+
+    Concurrent identical requests share the single network request.
+    Network failures are never cached, expired responses are dropped on misses.
+    Status notifications are received only for addresses subscribed with
+    subscribe(), i.e. watched ones, and listeners are called with the address
+    whenever its status changes. Responses of subscribed addresses are kept for
+    ttl seconds or until the status changes. Nothing tells the cache that other
+    addresses changed, so their responses are kept for unwatched_ttl seconds only,
+    which is enough to share them between the checks of the same moment.
+    """
+
+    class Flight(object):
+        "request which is in progress"
+        def __init__(self):
+            self.done = threading.Event()
+            self.value = None
+            self.error = None
+            self.stale = False
+
+    def __init__(self, ttl=60, unwatched_ttl=2):
+        self.ttl = ttl
+        self.unwatched_ttl = unwatched_ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.in_flight = {}
+        self.statuses = {}
+        # number of subscribers by (network, address)
+        self.subscribed = {}
+        # network callbacks of subscriptions by (network, address)
+        self.callbacks = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self.listeners = []
+
+    def get(self, network, address):
+        "returns the list of unspent outputs of address, network errors are raised"
+        key = (network, address)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = self.Flight()
+                self.misses += 1
+                self.expire()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                flight.value = network.synchronous_get(('blockchain.address.listunspent', [address]))
+            except Exception as e:
+                flight.error = e
+            with self.lock:
+                del self.in_flight[key]
+                if flight.error is None and not flight.stale:
+                    ttl = self.ttl if key in self.subscribed else self.unwatched_ttl
+                    self.entries[key] = (time.time() + ttl, flight.value)
+            flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return copy.deepcopy(flight.value)
+
+    def expire(self):
+        "drops expired responses, it is called under the lock"
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[key]
+
+    def invalidate(self, address):
+        "drops cached responses for address"
+        with self.lock:
+            self.invalidations += 1
+            for key in [key for key in self.entries if key[1] == address]:
+                del self.entries[key]
+            for key in self.in_flight:
+                if key[1] == address:
+                    self.in_flight[key].stale = True
+
+    def subscribe(self, network, address):
+        "subscribes to status notifications of address if network supports it"
+        key = (network, address)
+        if not hasattr(network, 'send'):
+            return
+        with self.lock:
+            self.subscribed[key] = self.subscribed.get(key, 0) + 1
+            if self.subscribed[key] > 1:
+                return
+            # the own callback of every address, so the network can drop it alone
+            callback = self.callbacks[key] = lambda response: self.on_address_status(response)
+        try:
+            network.send([('blockchain.address.subscribe', [address])], callback)
+        except Exception:
+            with self.lock:
+                self.subscribed.pop(key, None)
+                self.callbacks.pop(key, None)
+
+    def unsubscribe(self, network, address):
+        """
+        Drops the subscription made by subscribe. When the last subscriber is gone
+        the network callback is removed, the status and cached responses of address
+        are forgotten and its notifications are ignored
+        """
+        key = (network, address)
+        with self.lock:
+            if key not in self.subscribed:
+                return
+            self.subscribed[key] -= 1
+            if self.subscribed[key] > 0:
+                return
+            del self.subscribed[key]
+            callback = self.callbacks.pop(key, None)
+            # nothing invalidates the response anymore
+            self.entries.pop(key, None)
+            if not any(subscribed[1] == address for subscribed in self.subscribed):
+                self.statuses.pop(address, None)
+        # Electron Cash can not unsubscribe on the server, it only drops the callback
+        if callback is not None and hasattr(network, 'unsubscribe'):
+            try:
+                network.unsubscribe(callback)
+            except Exception:
+                pass
+
+    def on_address_status(self, response):
+        "network callback for address status notifications"
+        params = response.get('params', [])
+        if not params:
+            return
+        address = params[0]
+        status = params[1] if len(params) > 1 else response.get('result')
+        with self.lock:
+            if not any(key[1] == address for key in self.subscribed):
+                return
+            known = address in self.statuses
+            changed = known and self.statuses[address] != status
+            self.statuses[address] = status
+        # the first response only reports the current status, nothing is changed yet
+        if changed:
+            self.invalidate(address)
+            for listener in list(self.listeners):
+                listener(address)
+
+    def add_listener(self, listener):
+        "adds the callback for status changes of addresses"
+        with self.lock:
+            if listener not in self.listeners:
+                self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        "removes the callback added by add_listener"
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def stats(self):
+        "returns the counters of the cache"
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'invalidations': self.invalidations,
+                'size': len(self.entries)}
+
+unspent_cache = UnspentCache()
+
+class SighashContext(object):
+    """
+    Signature hash context of unsigned transaction.
+
+    hashPrevouts, hashSequence and hashOutputs parts of the BIP143-style preimage
+    are the same for every input, so they are computed once per transaction
+    instead of once per input.
+    """
+
+    def __init__(self, transaction, skeleton=None, counters=null_counters):
+        self.transaction = transaction
+        self.counters = counters
+        inputs = transaction.inputs()
+        self.indexes = {}
+        for i, txin in enumerate(inputs):
+            for pubkey in txin['pubkeys']:
+                self.indexes.setdefault(pubkey, i)
+        self.version = int_to_hex(transaction.version, 4)
+        self.hash_type = int_to_hex(transaction.nHashType(), 4)
+        self.locktime = int_to_hex(transaction.locktime, 4)
+        if skeleton is None:
+            self.hash_prevouts, self.hash_sequence = self.inputs_hashes(transaction)
+        else:
+            self.hash_prevouts, self.hash_sequence = skeleton.inputs_hashes
+        counters.count('hash', 1 if skeleton is not None else 3)
+        counters.count('tx_serialize')
+        self.hash_outputs = bh2u(Hash(bfh(''.join(transaction.serialize_output(output)
+                                                  for output in transaction.outputs()))))
+        # The layout above follows Transaction.serialize_preimage.
+        # Fall back to it if electroncash serializes preimages differently
+        self.compatible = (not inputs or
+                           self.preimage(0) == transaction.serialize_preimage(0))
+
+    @staticmethod
+    def sequence(txin):
+        return txin.get('sequence', 0xffffffff - 1)
+
+    @classmethod
+    def inputs_hashes(cls, transaction):
+        "returns hashPrevouts and hashSequence of transaction in a hex form"
+        inputs = transaction.inputs()
+        hash_prevouts = bh2u(Hash(bfh(''.join(transaction.serialize_outpoint(txin)
+                                              for txin in inputs))))
+        hash_sequence = bh2u(Hash(bfh(''.join(int_to_hex(cls.sequence(txin), 4)
+                                              for txin in inputs))))
+        return hash_prevouts, hash_sequence
+
+    def index(self, verification_key):
+        "returns the index of input spent by verification key or None"
+        return self.indexes.get(verification_key)
+
+    def preimage(self, i):
+        "returns the preimage of i-th input in a hex form"
+        txin = self.transaction.inputs()[i]
+        preimage_script = self.transaction.get_preimage_script(txin)
+        return (self.version +
+                self.hash_prevouts +
+                self.hash_sequence +
+                self.transaction.serialize_outpoint(txin) +
+                var_int(len(preimage_script) // 2) + preimage_script +
+                int_to_hex(txin['value'], 8) +
+                int_to_hex(self.sequence(txin), 4) +
+                self.hash_outputs +
+                self.locktime +
+                self.hash_type)
+
+    def digest(self, i):
+        "returns the signature hash of i-th input"
+        self.counters.count('hash')
+        self.counters.count('tx_serialize')
+        if self.compatible:
+            return Hash(bfh(self.preimage(i)))
+        return Hash(bfh(self.transaction.serialize_preimage(i)))
+
+class TransactionSkeleton(object):
+    """
+    Inputs and change outputs of the shuffle transaction.
+    They are known after the announcement phase, so the skeleton can be made
+    while players shuffle. Only the shuffled outputs are added at the end
+    """
+
+    def __init__(self, inputs, changes, change_keys=None):
+        self.inputs = inputs
+        self.changes = changes
+        # verification keys of change outputs owners
+        self.change_keys = [None] * len(changes) if change_keys is None else change_keys
+        self.inputs_hashes = SighashContext.inputs_hashes(Transaction.from_io(inputs, []))
+
+    def without(self, verification_keys):
+        """
+        returns the skeleton without inputs and change outputs of verification keys.
+        It is used after the blame exclusion, so coins of the rest are not requested again
+        """
+        inputs = [txin for txin in self.inputs if txin['pubkeys'][0] not in verification_keys]
+        changes = [(key, change) for key, change in zip(self.change_keys, self.changes)
+                   if key not in verification_keys]
+        return TransactionSkeleton(inputs,
+                                   [change for key, change in changes],
+                                   [key for key, change in changes])
+
+    def complete(self, outputs):
+        "makes unsigned transaction with outputs and changes, skeleton itself stays untouched"
+        transaction = Transaction.from_io([dict(txin) for txin in self.inputs], outputs)
+        transaction.add_outputs(list(self.changes))
+        return transaction
+
+class KeyInfo(object):
+    """
+    Metadata of verification key: serialized key, compression flag, P2PKH address
+    and parsed point. It is made once per key and shared by the whole round.
+    The point is parsed only when it is needed, since keys of other players can be invalid
+    """
+    __slots__ = ('key', 'data', 'compressed', 'address', '_address_object', '_verifying_key')
+
+    def __init__(self, verification_key):
+        self.key = verification_key
+        self.data = bytes.fromhex(verification_key)
+        self.compressed = len(self.data) == 33
+        self.address = public_key_to_p2pkh(self.data)
+        self._address_object = None
+        self._verifying_key = None
+
+    @property
+    def address_object(self):
+        "address as Address object"
+        if self._address_object is None:
+            self._address_object = Address.from_string(self.address)
+        return self._address_object
+
+    @property
+    def verifying_key(self):
+        "verifying key object with parsed point"
+        if self._verifying_key is None:
+            self._verifying_key = MyVerifyingKey.from_public_point(ser_to_point(self.data),
+                                                                   curve=SECP256k1)
+        return self._verifying_key
+
+    @property
+    def point(self):
+        "parsed point of the key"
+        return self.verifying_key.pubkey.point
+
+class SigningContext(object):
+    """
+    Signing key of the player made once per round.
+
+    self_verify is the policy of checking own signatures:
+        'always' - every signature is verified (default)
+        'sampled' - signatures are verified with sample_rate probability
+        'never' - signatures are not verified
+        'debug' - signatures are verified unless python runs with -O
+    """
+    POLICIES = frozenset(['always', 'sampled', 'never', 'debug'])
+
+    def __init__(self, secret_key, self_verify='always', sample_rate=0.1, counters=null_counters):
+        assert self_verify in self.POLICIES, 'Wrong self verification policy'
+        self.counters = counters
+        self.secret_key = secret_key
+        self.signing_key = MySigningKey.from_secret_exponent(secret_key.secret, curve=SECP256k1)
+        self.verifying_key = self.signing_key.get_verifying_key()
+        counters.count('ec_mult')
+        self.self_verify = self_verify
+        self.sample_rate = sample_rate
+
+    def is_verification_needed(self):
+        "decides if the next signature should be verified"
+        if self.self_verify == 'sampled':
+            return random.random() < self.sample_rate
+        if self.self_verify == 'debug':
+            return __debug__
+        return self.self_verify == 'always'
+
+    def sign_digest(self, digest):
+        "signs the digest deterministically, returns DER encoded signature"
+        self.counters.count('ecdsa_sign')
+        sig = self.signing_key.sign_digest_deterministic(digest,
+                                                         hashfunc=hashlib.sha256,
+                                                         sigencode=ecdsa.util.sigencode_der)
+        if self.is_verification_needed():
+            self.counters.count('ecdsa_verify')
+            # not an assert, so the policy works under python -O too
+            if not self.verifying_key.verify_digest(sig, digest, sigdecode=ecdsa.util.sigdecode_der):
+                raise ecdsa.BadSignatureError('own signature is not valid')
+        return sig
+
+class Broadcaster(object):
+    """
+    Sends the transaction to several servers in parallel.
+
+    Every server gets its own attempts with exponential backoff on network
+    errors. Electron Cash Network.broadcast reports them as (False, 'error: ...')
+    the same way as rejections, so they are told apart by the message.
+    Rejections are final, except of 'already known' ones, which mean
+    that the transaction is already in the mempool, so they count as success.
+    The first success is returned at once. The rest of servers are left to
+    finish in background and the propagation of transaction is tracked there
+    until every server sees it, if there is more than one server.
+    Results are waited for until the single deadline, which covers every attempt
+    of every server: request_timeout is the timeout of Network.broadcast itself.
+    Metrics of the last broadcast are kept in the metrics dict.
+    """
+    ALREADY_KNOWN = ('already in mempool', 'txn-already-in-mempool',
+                     'txn-already-known', 'transaction already in block chain')
+    # messages of requests lost on the way to the server or back
+    TRANSPORT_ERRORS = ('server did not answer', 'timeout', 'timed out', 'not connected',
+                        'connection', 'socket', 'broken pipe')
+
+    def __init__(self, retries=3, backoff=0.5, request_timeout=30, track_timeout=60,
+                 track_interval=2):
+        self.retries = retries
+        self.backoff = backoff
+        self.request_timeout = request_timeout
+        self.track_timeout = track_timeout
+        self.track_interval = track_interval
+        self.metrics = {}
+
+    @classmethod
+    def is_already_known(cls, message):
+        message = str(message).lower()
+        return any(reason in message for reason in cls.ALREADY_KNOWN)
+
+    @classmethod
+    def is_transport_error(cls, message):
+        "checks if the failed broadcast lost the request instead of being rejected"
+        message = str(message).lower().strip()
+        if message.startswith('error:'):
+            message = message[len('error:'):].strip()
+        # timed out requests of Network.synchronous_get have no message at all
+        return not message or any(reason in message for reason in cls.TRANSPORT_ERRORS)
+
+    @property
+    def timeout(self):
+        "the longest time of broadcast_to: every attempt times out and every backoff is waited"
+        backoffs = sum(self.backoff * 2 ** (attempt - 1) for attempt in range(1, self.retries))
+        return self.retries * self.request_timeout + backoffs
+
+    @staticmethod
+    def txid(transaction):
+        try:
+            return transaction.txid()
+        except Exception:
+            return None
+
+    def broadcast_to(self, network, transaction):
+        """
+        broadcasts the transaction to the single server.
+        Returns (True, txid), (False, rejection message) or (None, None) on network fault
+        """
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                accepted, message = network.broadcast(transaction)
+            except Exception:
+                continue
+            if accepted:
+                return True, message
+            if self.is_already_known(message):
+                return True, self.txid(transaction) or message
+            if self.is_transport_error(message):
+                continue
+            return False, message
+        return None, None
+
+    def broadcast(self, transaction, networks):
+        """
+        broadcasts the transaction to all of the networks.
+        Returns the first success, otherwise the first rejection, otherwise (None, None)
+        """
+        start = time.time()
+        networks = list(networks)
+        self.metrics = {'servers': len(networks), 'time_to_broadcast': None,
+                        'time_to_seen': None, 'seen_by': 0}
+        results = queue.Queue()
+        for network in networks:
+            threading.Thread(target=lambda network=network:
+                             results.put((network, self.broadcast_to(network, transaction))),
+                             daemon=True).start()
+        rejection = None
+        deadline = start + self.timeout
+        for _ in networks:
+            try:
+                network, (accepted, message) = results.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                # every server had the time for all of its attempts
+                break
+            if accepted:
+                self.metrics['time_to_broadcast'] = time.time() - start
+                txid = self.txid(transaction)
+                if txid and len(networks) > 1:
+                    threading.Thread(target=self.track, args=(txid, networks, start, self.metrics),
+                                     daemon=True).start()
+                return accepted, message
+            if accepted is False and rejection is None:
+                rejection = (accepted, message)
+        return rejection or (None, None)
+
+    def track(self, txid, networks, start, metrics):
+        "polls the servers until every of them knows the transaction"
+        waiting = list(networks)
+        deadline = start + self.track_timeout
+        while waiting and time.time() < deadline:
+            for network in list(waiting):
+                try:
+                    if network.synchronous_get(('blockchain.transaction.get', [txid])):
+                        waiting.remove(network)
+                        metrics['seen_by'] += 1
+                except Exception:
+                    pass
+            if waiting:
+                time.sleep(self.track_interval)
+        if not waiting:
+            metrics['time_to_seen'] = time.time() - start
+
+class ServerBroadcast(object):
+    """
+    The single Electrum server for the Broadcaster, given as 'host:port:protocol'.
+
+    Electron Cash Network sends requests with callbacks to its main server only,
+    so extra broadcast servers can not go through it. Instead of the full Network
+    with its own header sync, every request makes the short connection of its own,
+    which costs nothing between rounds. It has broadcast and synchronous_get of
+    Network, the methods Broadcaster uses.
+    """
+
+    def __init__(self, server, timeout=30):
+        self.server = server
+        host, port, protocol = server.rsplit(':', 2)
+        self.host = host
+        self.port = int(port)
+        self.ssl = protocol == 's'
+        self.timeout = timeout
+
+    def connect(self, timeout):
+        sock = socket.create_connection((self.host, self.port), timeout)
+        if not self.ssl:
+            return sock
+        # Electrum servers often have self-signed certificates
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context.wrap_socket(sock, server_hostname=self.host)
+
+    def synchronous_get(self, request, timeout=None):
+        method, params = request
+        timeout = self.timeout if timeout is None else timeout
+        with self.connect(timeout) as sock:
+            data = json.dumps({"id": 0, "method": method, "params": params}) + '\n'
+            sock.sendall(data.encode('utf-8'))
+            reader = sock.makefile('rb')
+            line = reader.readline()
+        if not line:
+            raise Exception('Server did not answer')
+        response = json.loads(line.decode('utf-8'))
+        if response.get('error'):
+            error = response['error']
+            raise Exception(error.get('message', error) if isinstance(error, dict) else error)
+        return response.get('result')
+
+    def broadcast(self, transaction):
+        "the same answers as Network.broadcast"
+        try:
+            txid = self.synchronous_get(('blockchain.transaction.broadcast', [str(transaction)]))
+        except Exception as e:
+            return False, 'error: ' + str(e)
+        return True, txid
 
 class Coin(object):
     """
     it is a class for interaction with blockchain interaction
     will be fake functions for now
     """
+    counters = null_counters
 
-    def __init__(self, network):
+    def __init__(self, network, cache=None, max_requests=16, self_verify='always',
+                 broadcast_networks=None):
         self.network = network
+        # other servers to send the final transaction to
+        self.broadcast_networks = list(broadcast_networks or [])
+        self.broadcaster = Broadcaster()
+        self.cache = cache or unspent_cache
+        self.max_requests = max_requests
+        self.self_verify = self_verify
+        self.sighash = None
+        self.signing = None
+        self.keys = {}
+        self.prefetched = {}
+
+    def get_unspent(self, address):
+        """
+        returns the list of unspent outputs of address.
+        Prefetched responses are used first, others are shared
+        with all of the Coin objects through the cache
+        """
+        future = self.prefetched.get(address)
+        if future is not None:
+            try:
+                return copy.deepcopy(future.result())
+            except Exception:
+                # failed prefetch should not hide the next request
+                self.prefetched.pop(address, None)
+        return self.cache.get(self.network, address)
+
+    def prefetch_unspent(self, addresses):
+        """
+        Starts requests for unspent outputs of addresses in background.
+        Responses are kept by this object for the rest of the round
+        """
+        addresses = [address for address in set(addresses) if address not in self.prefetched]
+        if not addresses:
+            return
+        executor = ThreadPoolExecutor(max_workers=min(len(addresses), self.max_requests))
+        for address in addresses:
+            self.prefetched[address] = executor.submit(self.cache.get, self.network, address)
+        executor.shutdown(wait=False)
+
+    def get_unspent_batch(self, addresses):
+        """
+        returns the dict with lists of unspent outputs for every address.
+        Requests go concurrently, so all of them take about one round trip.
+        Network error is raised if any of requests fails
+        """
+        addresses = list(set(addresses))
+        if not addresses:
+            return {}
+        workers = min(len(addresses), self.max_requests)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(addresses, executor.map(self.get_unspent, addresses)))
+
+    def sufficient_funds_batch(self, addresses, amount):
+        """
+        Checks for sufficient funds on every address at once.
+        Returns dict of address to result of check
+
+        if network object raise exception then this function returns None
+        """
+        try:
+            unspent = self.get_unspent_batch(addresses)
+        except:
+            return None
+        return {address: any(utxo['value'] > amount for utxo in unspent[address])
+                for address in unspent}
 
     def sufficient_funds(self, address, amount):
         """
@@ -24,15 +641,22 @@ class Coin(object):
         if network object raise exception then this function returns None
         """
         try:
-            unspent_list = self.network.synchronous_get(('blockchain.address.listunspent', [address]))
+            unspent_list = self.get_unspent(address)
             values = [uxto['value'] for uxto in unspent_list]
             return len([i for i in values if i > amount]) > 0
         except:
             return None
 
+    def key_info(self, verification_key):
+        "get metadata of verification key, it is made once per key"
+        info = self.keys.get(verification_key)
+        if info is None:
+            info = self.keys[verification_key] = KeyInfo(verification_key)
+        return info
+
     def address(self, verification_key):
         "get address from public key"
-        return public_key_to_p2pkh(bytes.fromhex(verification_key))
+        return self.key_info(verification_key).address
 
     def get_first_sufficient_utxo(self, address, amount):
         """
@@ -43,24 +667,49 @@ class Coin(object):
         It is supposed to have single output for address to be shuffled
         """
 
-        coins = self.network.synchronous_get(('blockchain.address.listunspent', [address]))
+        coins = self.get_unspent(address)
         coins = [coin for coin in coins if coin['value'] >= amount]
         if coins:
             return coins[0]
         else:
             return None
 
+    def sighash_context(self, transaction):
+        "returns the signature hash context of transaction, it is made once per transaction"
+        if self.sighash is None or self.sighash.transaction is not transaction:
+            self.sighash = SighashContext(transaction, counters=self.counters)
+        return self.sighash
+
+    def signing_context(self, secret_key):
+        "returns the signing context of secret key, it is made once per key"
+        if self.signing is None or self.signing.secret_key is not secret_key:
+            self.signing = SigningContext(secret_key, self_verify=self.self_verify,
+                                          counters=self.counters)
+        return self.signing
+
     def make_unsigned_transaction(self, amount, fee, inputs, outputs, changes):
         "make unsigned transaction"
+        skeleton = self.make_transaction_skeleton(amount, fee, inputs, changes)
+        if skeleton is None:
+            return None
+        return self.complete_transaction(skeleton, amount, outputs)
+
+    def make_transaction_skeleton(self, amount, fee, inputs, changes):
+        """
+        make inputs and change outputs of unsigned transaction
+
+        if network object raise exception then this function returns None
+        """
         coins = {}
         try:
+            self.get_unspent_batch(inputs.values())
             coins = {verification_key : self.get_first_sufficient_utxo(inputs[verification_key], amount + fee)
                      for verification_key in inputs}
         except:
             return None
         for verification_key in coins:
             coins[verification_key]['type'] = 'p2pkh'
-            coins[verification_key]['address'] = Address.from_string(self.address(verification_key))
+            coins[verification_key]['address'] = self.key_info(verification_key).address_object
             coins[verification_key]['pubkeys'] = [verification_key]
             coins[verification_key]['x_pubkeys'] = [verification_key]
             coins[verification_key]['prevout_hash'] = coins[verification_key]['tx_hash']
@@ -68,29 +717,32 @@ class Coin(object):
             coins[verification_key]['signatures'] = [None]
             coins[verification_key]['num_sig'] = 1
         tx_inputs = [coins[verification_key] for verification_key in sorted(coins)]
-        tx_outputs = [(TYPE_ADDRESS, Address.from_string(output), int(amount))
-                      for output in outputs]
-        transaction = Transaction.from_io(tx_inputs, tx_outputs)
+        change_keys = [verification_key for verification_key in sorted(changes)
+                       if Address.is_valid(changes[verification_key])]
         tx_changes = [(TYPE_ADDRESS,
                        Address.from_string(changes[verification_key]),
                        int(coins[verification_key]['value'] - amount - fee))
-                      for verification_key in sorted(changes)
-                      if Address.is_valid(changes[verification_key])]
-        transaction.add_outputs(tx_changes)
+                      for verification_key in change_keys]
+        # hashPrevouts and hashSequence of the skeleton
+        self.counters.count('hash', 2)
+        self.counters.count('tx_serialize')
+        return TransactionSkeleton(tx_inputs, tx_changes, change_keys)
+
+    def complete_transaction(self, skeleton, amount, outputs):
+        "make unsigned transaction from skeleton and shuffled outputs"
+        tx_outputs = [(TYPE_ADDRESS, Address.from_string(output), int(amount))
+                      for output in outputs]
+        transaction = skeleton.complete(tx_outputs)
+        self.sighash = SighashContext(transaction, skeleton, counters=self.counters)
         return transaction
 
     def get_transaction_signature(self, transaction, secret_key, verification_key):
         "get transaction signature"
-        txin = list(filter(lambda x: verification_key in x['pubkeys'], transaction.inputs()))
-        if txin:
-            tx_num = transaction.inputs().index(txin[0])
-            pre_hash = Hash(bfh(transaction.serialize_preimage(tx_num)))
-            private_key = MySigningKey.from_secret_exponent(secret_key.secret, curve=SECP256k1)
-            public_key = private_key.get_verifying_key()
-            sig = private_key.sign_digest_deterministic(pre_hash,
-                                                        hashfunc=hashlib.sha256,
-                                                        sigencode=ecdsa.util.sigencode_der)
-            assert public_key.verify_digest(sig, pre_hash, sigdecode=ecdsa.util.sigdecode_der)
+        sighash = self.sighash_context(transaction)
+        tx_num = sighash.index(verification_key)
+        if tx_num is not None:
+            pre_hash = sighash.digest(tx_num)
+            sig = self.signing_context(secret_key).sign_digest(pre_hash)
             result = bh2u(sig) + int_to_hex(transaction.nHashType() & 255, 1)
             return result.encode('utf-8')
         return b''
@@ -101,40 +753,268 @@ class Coin(object):
         # transaction._inputs
         for i, txin in enumerate(inputs):
             inputs[i]['signatures'] = [signatures.get(inputs[i]['pubkeys'][0]).decode()]
-            transaction.raw = transaction.serialize()
+        # serialize the whole transaction once, after all of signatures are in place
+        transaction.raw = transaction.serialize()
+        self.counters.count('tx_serialize')
         return transaction
 
     def verify_tx_signature(self, signature, transaction, verification_key):
         "It verifies the transaction signatures"
-        txin = list(filter(lambda x: verification_key in x['pubkeys'], transaction.inputs()))
-        if txin:
-            tx_num = transaction.inputs().index(txin[0])
-            pre_hash = Hash(bfh(transaction.serialize_preimage(tx_num)))
-            order = generator_secp256k1.order()
-            r, s = ecdsa.util.sigdecode_der(bfh(signature.decode()[:-2]), order)
-            sig_string = ecdsa.util.sigencode_string(r, s, order)
-            compressed = len(verification_key) <= 66
-            for recid in range(0, 4):
-                try:
-                    pubk = MyVerifyingKey.from_signature(sig_string, recid,
-                                                         pre_hash, curve=SECP256k1)
-                    pubkey = bh2u(point_to_ser(pubk.pubkey.point, compressed))
-                    if verification_key == pubkey:
-                        return True
-                except:
-                    continue
+        sighash = self.sighash_context(transaction)
+        tx_num = sighash.index(verification_key)
+        if tx_num is not None:
+            pre_hash = sighash.digest(tx_num)
+            self.counters.count('ecdsa_verify')
+            try:
+                return self.key_info(verification_key).verifying_key.verify_digest(
+                    bfh(signature.decode()[:-2]), pre_hash, sigdecode=ecdsa.util.sigdecode_der)
+            except Exception:
+                return False
         else:
             return False
 
+    def verify_tx_signatures(self, signatures, transaction):
+        """
+        It verifies the transaction signatures of all players at once.
+        signatures is a dict of signatures by verification keys.
+        Returns the list of verification keys with wrong signatures
+        """
+        self.sighash_context(transaction)
+        return [verification_key for verification_key in signatures
+                if not self.verify_tx_signature(signatures[verification_key],
+                                                transaction,
+                                                verification_key)]
+
     def broadcast_transaction(self, transaction):
-        try:
-            return self.network.broadcast(transaction)
-        except:
-            return None, None
+        """
+        broadcasts the transaction to the network and to the broadcast networks in parallel.
+        Returns (None, None) if none of them are reachable
+        """
+        networks = [self.network] + [network for network in self.broadcast_networks
+                                     if network is not self.network]
+        return self.broadcaster.broadcast(transaction, networks)
 
     def verify_signature(self, signature, message, verification_key):
         "This method verifies signature of message"
+        self.counters.count('hash')
+        self.counters.count('ecdsa_recover')
         pk, compressed = pubkey_from_signature(signature, Hash(msg_magic(message)))
-        address_from_signature = public_key_to_p2pkh(point_to_ser(pk.pubkey.point, compressed))
-        address_from_vk = self.address(verification_key)
-        return address_from_signature == address_from_vk
+        # the same serialized keys are the same addresses, so no hashing is needed
+        return point_to_ser(pk.pubkey.point, compressed) == self.key_info(verification_key).data
+
+class AsyncCoin(object):
+    """
+    Non-blocking adapter of Coin.
+
+    Network methods run on the small thread pool and return
+    concurrent.futures.Future objects, so the protocol thread can go on with
+    messages processing. Use result() to wait for the value with timeout.
+    Note that timeout does not abort the request itself, it only stops waiting for it.
+    Round builds the skeleton in background while players shuffle. The funds
+    check and the broadcast go through the adapter too, for the same timeouts,
+    but the round waits for them at once: nothing can be announced before the
+    exclusions are known and nothing is left to do after the broadcast.
+    """
+
+    def __init__(self, coin, timeout=30, max_workers=2):
+        self.coin = coin
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.executor = None
+
+    def submit(self, method, *args):
+        "runs the Coin method (its name or the callable) with args in background, returns the future"
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        func = method if callable(method) else getattr(self.coin, method)
+        counters = getattr(self.coin, 'counters', null_counters)
+        if counters.enabled:
+            # the work is counted to the phase which requested it
+            return self.executor.submit(counters.call_in_phase, counters.phase, func, *args)
+        return self.executor.submit(func, *args)
+
+    def sufficient_funds(self, address, amount):
+        return self.submit('sufficient_funds', address, amount)
+
+    def sufficient_funds_batch(self, addresses, amount):
+        return self.submit('sufficient_funds_batch', list(addresses), amount)
+
+    def get_unspent_batch(self, addresses):
+        return self.submit('get_unspent_batch', list(addresses))
+
+    def make_unsigned_transaction(self, amount, fee, inputs, outputs, changes):
+        return self.submit('make_unsigned_transaction', amount, fee, inputs, outputs, changes)
+
+    def make_transaction_skeleton(self, amount, fee, inputs, changes):
+        return self.submit('make_transaction_skeleton', amount, fee, inputs, changes)
+
+    def broadcast_transaction(self, transaction):
+        return self.submit('broadcast_transaction', transaction)
+
+    def result(self, future, timeout=None, default=None):
+        """
+        waits for the result of future.
+        Returns default value if time is out or request raised an exception
+        """
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except Exception:
+            return default
+
+    def shutdown(self):
+        "stops the thread pool without waiting for requests in progress"
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+class UnspentWatcher(object):
+    """
+    Local index of unspent outputs of watched addresses.
+
+    It subscribes to status notifications of addresses through the cache and
+    updates the index of the changed address only, instead of polling all of
+    them. Listeners are called as listener(address, removed, added) with the
+    lists of outputs which disappeared from the address and appeared on it.
+    Refreshes run on the own thread, so network callbacks never block.
+    """
+
+    def __init__(self, coin):
+        self.coin = coin
+        self.lock = threading.Lock()
+        self.index = {}
+        # initial loads of watched addresses
+        self.loading = {}
+        self.listeners = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.coin.cache.add_listener(self.on_address_changed)
+
+    @staticmethod
+    def outpoint(utxo):
+        return (utxo['tx_hash'], utxo['tx_pos'])
+
+    def add_listener(self, listener):
+        "adds the callback for changes of watched addresses"
+        self.listeners.append(listener)
+
+    def watch(self, addresses, wait=False):
+        """
+        starts watching for addresses. Initial lists of unspent outputs are
+        loaded in background, use wait=True to wait for them
+        """
+        futures = []
+        for address in set(addresses):
+            with self.lock:
+                if address in self.index:
+                    continue
+                self.index[address] = None
+            self.coin.cache.subscribe(self.coin.network, address)
+            # the first load is compared with the prefetched response, so it is not taken
+            # from the cache, which could have been filled by the prefetch itself
+            self.coin.cache.invalidate(address)
+            future = self.executor.submit(self.refresh, address)
+            with self.lock:
+                self.loading[address] = future
+            futures.append(future)
+        if wait and futures:
+            wait_futures(futures)
+
+    def wait_loaded(self, addresses, timeout=None):
+        "waits until the initial lists of unspent outputs of watched addresses are loaded"
+        with self.lock:
+            futures = [self.loading[address] for address in set(addresses)
+                       if address in self.loading]
+        if futures:
+            wait_futures(futures, timeout=timeout)
+
+    def watch_only(self, addresses, wait=False):
+        """
+        makes addresses the whole watched set: addresses which are not there anymore,
+        e.g. ones with spent coins, are unwatched and new ones are watched
+        """
+        addresses = set(addresses)
+        with self.lock:
+            gone = [address for address in self.index if address not in addresses]
+        self.unwatch(gone)
+        self.watch(addresses, wait=wait)
+
+    def unwatch(self, addresses):
+        "stops watching for addresses"
+        for address in set(addresses):
+            with self.lock:
+                if address not in self.index:
+                    continue
+                del self.index[address]
+                self.loading.pop(address, None)
+            self.coin.cache.unsubscribe(self.coin.network, address)
+
+    def on_address_changed(self, address):
+        "cache callback for status changes"
+        if address in self.index:
+            self.executor.submit(self.refresh, address)
+
+    def refresh(self, address):
+        "reloads the unspent outputs of address and notifies listeners about the difference"
+        with self.lock:
+            loaded = self.index.get(address) is not None
+        if loaded:
+            # the status changed after the first load, the prefetched response is outdated
+            self.coin.prefetched.pop(address, None)
+        try:
+            utxos = self.coin.cache.get(self.coin.network, address)
+        except Exception:
+            return
+        current = {self.outpoint(utxo): utxo for utxo in utxos}
+        with self.lock:
+            if address not in self.index:
+                return
+            previous = self.index[address]
+            self.index[address] = current
+        if previous is None:
+            self.check_prefetched(address, current)
+            return
+        removed = [previous[key] for key in previous if key not in current]
+        added = [current[key] for key in current if key not in previous]
+        if removed or added:
+            for listener in list(self.listeners):
+                listener(address, removed, added)
+
+    def check_prefetched(self, address, current):
+        """
+        Compares the first load of address with its prefetched response.
+        The prefetched one is kept only if it has the same outputs, so it is reused
+        when nothing changed since the prefetch
+        """
+        future = self.coin.prefetched.get(address)
+        if future is None:
+            return
+        try:
+            prefetched = {self.outpoint(utxo) for utxo in future.result(timeout=0)}
+        except Exception:
+            prefetched = None
+        if prefetched != set(current):
+            self.coin.prefetched.pop(address, None)
+
+    def get_unspent(self, address):
+        "returns the indexed unspent outputs of address or None if it is not loaded yet"
+        with self.lock:
+            entry = self.index.get(address)
+            return None if entry is None else copy.deepcopy(list(entry.values()))
+
+    def get_first_sufficient_utxo(self, address, amount):
+        "the same as Coin.get_first_sufficient_utxo, but served from the index when possible"
+        coins = self.get_unspent(address)
+        if coins is None:
+            return self.coin.get_first_sufficient_utxo(address, amount)
+        coins = [coin for coin in coins if coin['value'] >= amount]
+        return coins[0] if coins else None
+
+    def stop(self):
+        "stops watching and releases the thread"
+        self.coin.cache.remove_listener(self.on_address_changed)
+        with self.lock:
+            addresses = list(self.index)
+            self.index.clear()
+            self.loading.clear()
+        for address in addresses:
+            self.coin.cache.unsubscribe(self.coin.network, address)
+        self.executor.shutdown(wait=False)
@@ -1,24 +1,211 @@
+import time
+import hashlib
+from concurrent.futures import Future
+from .crypto import EquivocationHash
+from .coin import AsyncCoin, UnspentWatcher
+from .phase import Phase, PhaseType, TRANSITIONS
+from .events import EventKind, Level, LogEvent
+from .tracing import null_tracer, null_counters
+
 class BlameException(Exception):
     pass
 
+class PlayerRing(object):
+    """
+    Players of the round in the order of their indexes.
+
+    It is built once from the players dict {index: verification key} and
+    answers the neighbour and inverse lookups in O(1)
+    """
+    __slots__ = ('indexes', 'keys', 'positions', 'numbers', 'places')
+
+    def __init__(self, players):
+        self.indexes = sorted(players)
+        self.keys = [players[index] for index in self.indexes]
+        self.positions = {index: position for position, index in enumerate(self.indexes)}
+        self.numbers = {players[index]: index for index in self.indexes}
+        self.places = {key: position for position, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def first(self):
+        return self.indexes[0] if self.indexes else None
+
+    def last(self):
+        return self.indexes[-1] if self.indexes else None
+
+    def next(self, index):
+        "index of the next player, None for the last one"
+        position = self.positions[index] + 1
+        return self.indexes[position] if position < len(self.indexes) else None
+
+    def previous(self, index):
+        "index of the previous player, None for the first one"
+        position = self.positions[index] - 1
+        return self.indexes[position] if position >= 0 else None
+
+    def player_of(self, verification_key):
+        "index of the player with verification key, None for unknown keys"
+        return self.numbers.get(verification_key)
+
+    def position_of(self, verification_key):
+        "position of the player with verification key in the ring, None for unknown keys"
+        return self.places.get(verification_key)
+
+
+class PhaseInbox(object):
+    """
+    Received frames of the single phase.
+
+    Frames are kept in the array by position of the sender in the player ring,
+    the bitmap of received positions and the counter make the completion check O(1).
+    Round looks the position up once, when it checks that the sender is a player,
+    and stores the frame with add(). For the phase handlers it works as the dict
+    {verification key: frame}, in the order of the ring.
+    """
+    __slots__ = ('ring', 'frames', 'bitmap', 'count', 'complete')
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.frames = [None] * len(ring)
+        self.bitmap = 0
+        self.count = 0
+        self.complete = (1 << len(ring)) - 1
+
+    def is_complete(self):
+        return self.bitmap == self.complete
+
+    def add(self, position, frame):
+        "stores the frame of the player at position in the ring"
+        if self.frames[position] is None:
+            self.bitmap |= 1 << position
+            self.count += 1
+        self.frames[position] = frame
+
+    def __setitem__(self, verification_key, frame):
+        self.add(self.ring.places[verification_key], frame)
+
+    def __getitem__(self, verification_key):
+        frame = self.frames[self.ring.places[verification_key]]
+        if frame is None:
+            raise KeyError(verification_key)
+        return frame
+
+    def __delitem__(self, verification_key):
+        position = self.ring.places[verification_key]
+        if self.frames[position] is None:
+            raise KeyError(verification_key)
+        self.frames[position] = None
+        self.bitmap &= ~(1 << position)
+        self.count -= 1
+
+    def get(self, verification_key, default=None):
+        position = self.ring.places.get(verification_key)
+        if position is None:
+            return default
+        frame = self.frames[position]
+        return default if frame is None else frame
+
+    def __contains__(self, verification_key):
+        return self.get(verification_key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for key, frame in zip(self.ring.keys, self.frames) if frame is not None]
+
+    def values(self):
+        return [frame for frame in self.frames if frame is not None]
+
+    def items(self):
+        return [(key, frame) for key, frame in zip(self.ring.keys, self.frames) if frame is not None]
+
+    def copy(self):
+        return dict(self.items())
+
+    def clear(self):
+        "drops all of the frames"
+        self.frames = [None] * len(self.ring)
+        self.bitmap = 0
+        self.count = 0
+
+    def rebind(self, ring):
+        "moves the frames to the new ring, frames of players out of it are dropped"
+        items = self.items()
+        self.__init__(ring)
+        for key, frame in items:
+            position = ring.position_of(key)
+            if position is not None:
+                self.add(position, frame)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
 class Round(object):
     """
     A single round of the protocol. It is possible that the players may go through
     several failed rounds until they have eliminated malicious players.
+
+    The round is a state machine over PhaseType. Handler of the phase runs
+    only when a frame of this phase comes or when the round enters the phase,
+    Blame frames are handled in any phase.
     """
 
+    # names of phase handlers, so subclasses can redefine them
+    HANDLERS = {
+        PhaseType.Announcement: 'process_announcement',
+        PhaseType.Shuffling: 'process_shuffling',
+        PhaseType.BroadcastOutput: 'process_broadcast_output',
+        PhaseType.EquivocationCheck: 'process_equivocation_check',
+        PhaseType.VerificationAndSubmission: 'process_verification_and_submission',
+        PhaseType.Blame: 'process_blame',
+    }
+
     def __init__(self, coin, crypto, messages,
                  inchan, outchan, logchan,
                  session, phase, amount, fee,
-                 sk, pubkey, players, addr_new, change):
+                 sk, pubkey, players, addr_new, change, tracer=None, counters=None,
+                 hash_version=EquivocationHash.LEGACY):
+        # fields of every trace event of the round, the player is added when known
+        self.tracer = tracer or null_tracer
+        # events below this level are not sent to logchan
+        self.log_level = Level.INFO
+        self.trace_fields = {'player': None}
+        self.phase_started = time.time()
+        # operation counters are shared by coin, crypto and messages of the round
+        self.counters = counters or null_counters
+        if self.counters.enabled:
+            for obj in (coin, crypto, messages):
+                if obj is not None:
+                    obj.counters = self.counters
+        coin = self.tracer.wrap(coin, 'coin', self.trace_fields) if coin else coin
         self.coin = coin
-        self.crypto = crypto
+        self.async_coin = AsyncCoin(coin)
+        self.skeleton_future = None
+        # players and change addresses of the skeleton request, to reuse it after the blame
+        self.skeleton_request = None
+        self.watcher = None
+        self.spent_coins = []
+        self.crypto = self.tracer.wrap(crypto, 'crypto', self.trace_fields)
         self.inchan = inchan
         self.outchan = outchan
         self.logchan = logchan
         self.session = session
         self.messages = messages
+        self.state = None
+        # blame recovery state is read by the phase setter
+        self.excluded = set()
+        self.blame_started = None
+        self.recovery_time = None
         self.phase = phase
+        self.handlers = {state: getattr(self, name) for state, name in self.HANDLERS.items()}
+        self.frame_phase = None
         assert (amount > 0), 'Wrong amount value'
         self.amount = amount
         assert (fee > 0), 'Wrong fee value'
@@ -30,36 +217,109 @@ class Round(object):
         self.players = players
         self.number_of_players = len(players)
         self.vk = pubkey
-        if self.number_of_players == len(set(players.values())):
-            if self.vk in players.values():
-                self.me = {players[player] : player for player in players}[self.vk]
+        if self.number_of_players == len(self.ring.numbers):
+            if self.vk in self.ring.numbers:
+                self.me = self.ring.player_of(self.vk)
+                self.trace_fields['player'] = self.me
             else:
-                self.logchan('Error: publick key is not in the players list')
+                self.log(EventKind.ERROR, 'Error: publick key is not in the players list')
                 self.done = True
                 return
         else:
-            self.logchan.send('Error: same publick keys appears in the pool!')
+            self.log(EventKind.ERROR, 'Error: same publick keys appears in the pool!')
             self.done = True
             return
         self.encryption_keys = dict()
         self.new_addresses = set()
+        self.equivocation = None
+        # version of the equivocation hash to send. Hashes of any version are accepted,
+        # but players do not agree on the version, so CANONICAL is sent only in pools
+        # where every client can check it, otherwise the round fails on equivocation
+        self.hash_version = hash_version
         self.addr_new = addr_new
         self.change = change
         self.change_addresses = {}
         self.signatures = dict()
-        self.inbox = {self.messages.phases[phase]:{} for phase in self.messages.phases}
-        self.debug = False
+        # digests of (signature, packet) by verification key of packets with valid signatures
+        self.verified_signatures = set()
+        self.inbox = self.new_inbox()
         self.transaction = None
+        self.signing_time = None
+        self.broadcast_time = None
         self.tx = None
         self.done = None
 
+    @property
+    def phase(self):
+        """Name of the current phase. Use state for the PhaseType value"""
+        return None if self.state is None else self.state.name
+
+    @phase.setter
+    def phase(self, value):
+        if isinstance(value, Phase):
+            value = value.phase
+        state = PhaseType[value] if isinstance(value, str) else PhaseType(value)
+        if state != self.state and state not in TRANSITIONS[self.state]:
+            raise ValueError("No transition from " + str(self.phase) + " to " + state.name)
+        if state != self.state and self.tracer.enabled:
+            now = time.time()
+            if self.state is not None:
+                self.tracer.emit('phase_exit', phase=self.state.name,
+                                 duration=now - self.phase_started, **self.trace_fields)
+            self.tracer.emit('phase_enter', phase=state.name, **self.trace_fields)
+            self.phase_started = now
+        if self.counters.enabled:
+            self.counters.phase = state.name
+        if state == PhaseType.Blame and self.blame_started is None:
+            self.blame_started = time.time()
+        self.state = state
+
+    @property
+    def debug(self):
+        """Debug events are logged. It is the same as log_level = Level.DEBUG"""
+        return self.log_level <= Level.DEBUG
+
+    @debug.setter
+    def debug(self, value):
+        self.log_level = Level.DEBUG if value else Level.INFO
+
+    @property
+    def players(self):
+        """Players dict {index: verification key}"""
+        return self.__players
+
+    @players.setter
+    def players(self, players):
+        # the ring is rebuilt only when players change, i.e. after the blame exclusion
+        self.__players = players
+        self.ring = PlayerRing(players)
+        for inbox in getattr(self, 'inbox', {}).values():
+            inbox.rebind(self.ring)
+
+    def new_inbox(self):
+        """Returns empty inboxes of all phases"""
+        return {state: PhaseInbox(self.ring) for state in PhaseType}
+
+    def release_frames(self, *states):
+        """
+        Frees the frames of phases which can not be used by any blame anymore.
+        Signatures of released frames are not replayed, so their digests are dropped too
+        """
+        for state in states:
+            self.inbox[state].clear()
+        self.verified_signatures.clear()
+
+    def player_of(self, verification_key):
+        """Returns the index of player with verification key"""
+        return self.ring.player_of(verification_key)
+
     def first_player(self):
         """Returns the first index of sorted players dict"""
-        return min(sorted(self.players))
+        return self.ring.first()
 
     def last_player(self):
         """Returns the last index of sorted players dict"""
-        return max(sorted(self.players))
+        return self.ring.last()
 
     def next_player(self, player=None):
         """
@@ -71,10 +331,7 @@ class Round(object):
         player = index of specified player (default None)
         """
         player = self.me if player is None else player
-        if player != self.last_player():
-            return sorted(self.players)[sorted(self.players).index(player) + 1]
-        else:
-            return None
+        return self.ring.next(player)
 
     def previous_player(self, player=None):
         """
@@ -86,29 +343,33 @@ class Round(object):
         player = index of specified player (default None)
         """
         player = self.me if player is None else player
-        if player is not self.first_player():
-            return sorted(self.players)[sorted(self.players).index(player) - 1]
-        else:
-            return None
+        return self.ring.previous(player)
 
     def from_last_to_previous(self):
         """
         Returns indexes of players dict in reversed order form last to previous
         with respect to current player
         """
-        index = sorted(self.players).index(self.next_player())
-        return reversed(sorted(self.players)[index:])
+        position = self.ring.positions[self.next_player()]
+        return reversed(self.ring.indexes[position:])
 
     def check_for_signatures(self):
         """
         Check for signature in packets in the messages objectself.
-        Raise Exception if signature verification fails
+        Raise Exception if signature verification fails.
+        Packets replayed in blame messages are verified only once
         """
         for sig, msg, player in self.messages.get_signatures_and_packets():
-            if not self.coin.verify_signature(sig, msg, player):
+            verified = (hashlib.sha256(sig + msg).digest(), player)
+            if verified in self.verified_signatures:
+                continue
+            if self.coin.verify_signature(sig, msg, player):
+                self.verified_signatures.add(verified)
+            else:
                 self.messages.blame_invalid_signature(self.players[player])
                 self.send_message()
-                self.logchan.send('Blame: player ' + player + ' message with wrong signature!')
+                self.log(EventKind.BLAME, 'Blame: player {player} message with wrong signature!',
+                         player=player, recoverable=False)
                 # raise BlameException('Player ' + player + ' message with wrong signature!')
 
     def ban_the_liar(self, accused):
@@ -123,22 +384,29 @@ class Round(object):
             2. parse the incoming message
             3. store the packets from message to inbox[phase][from_key]
         Then methods reads from inbox not from inchan. I need it to catch the message from "future"
+        The phase of stored frame is kept in frame_phase, it is None if frame is dropped
         """
+        self.frame_phase = None
         try:
-            val = self.inchan.recv()
+            with self.tracer.span('recv', **self.trace_fields):
+                val = self.inchan.recv()
             if val is None:
                 return None
             else:
-                self.messages.packets.ParseFromString(val)
+                self.messages.parse(val)
         except Exception:
-            self.logchan.send('Decoding Error!')
+            self.log(EventKind.MESSAGE, 'Decoding Error!', level=Level.WARNING)
         phase = self.messages.get_phase()
         from_key = self.messages.get_from_key()
         self.check_for_signatures()
-        if from_key in self.players.values():
-            self.inbox[phase][from_key] = val
-        if self.debug:
-            self.logchan.send("Player " + str(self.me)+"\n"+str(self.inbox))
+        position = self.ring.places.get(from_key)
+        if position is not None:
+            self.inbox[phase].add(position, val)
+            self.frame_phase = phase
+        if self.log_level <= Level.DEBUG:
+            # the snapshot is formatted later, when the event is read
+            self.log(EventKind.DEBUG, "Player {me}\n{inbox}", me=self.me,
+                     inbox={state: inbox.copy() for state, inbox in self.inbox.items() if inbox})
         return True
 
     def send_message(self, destination=None):
@@ -154,59 +422,131 @@ class Round(object):
                                        self.me,
                                        self.vk,
                                        destination,
-                                       self.phase)
-        self.outchan.send(self.messages.packets.SerializeToString())
+                                       self.phase,
+                                       compressed=self.coin.key_info(self.vk).compressed)
+        self.outchan.send(self.messages.serialize())
 
-    def log_message(self, message):
-        """Sends message from current player to log channel"""
-        self.logchan.send("Player " + str(self.me) + " " + message)
+    def log(self, kind, template, level=None, **fields):
+        """
+        Sends the event to log channel if its level is enabled.
+        The text is formatted from template and fields only when the event is read
+        """
+        event = LogEvent(kind, template, level, **fields)
+        if event.level >= self.log_level:
+            self.logchan.send(event)
+
+    def log_message(self, message, kind=EventKind.PROGRESS, **fields):
+        """
+        Sends message from current player to log channel.
+        message is formatted with fields and goes into the event as a field,
+        so text without fields is never read as a template
+        """
+        text = LogEvent(kind, message, **fields)
+        self.log(kind, "Player {me} {text}", me=self.me, text=text, **fields)
 
     def blame_insufficient_funds(self):
         """
         Checks for all players to have a sufficient funds to do the shuffling
         Enter the Blame phase if someone have no funds for shuffling
         """
-        offenders = list()
-        for player in self.players:
-            address = self.coin.address(self.players[player])
-            is_funds_sufficient = self.coin.sufficient_funds(address, self.amount + self.fee)
-            if is_funds_sufficient == None:
-                self.logchan.send("Error: blockchain network fault!")
-                self.done = True
-                return None
-            # if not self.coin.sufficient_funds(address, self.amount + self.fee):
-            elif not self.coin.sufficient_funds(address, self.amount + self.fee):
-                offenders.append(self.players[player])
+        addresses = {player: self.coin.address(self.players[player]) for player in self.players}
+        # the announcement waits for the exclusions, so the thread waits, but not forever
+        funds = self.async_coin.result(
+            self.async_coin.sufficient_funds_batch(addresses.values(), self.amount + self.fee))
+        if funds == None:
+            self.log(EventKind.ERROR, "Error: blockchain network fault!")
+            self.done = True
+            return None
+        offenders = [self.players[player] for player in self.players
+                     if not funds[addresses[player]]]
 
         if len(offenders) == 0:
             self.log_message("finds sufficient funds")
+            self.watch_coins()
             return True
         else:
             self.phase = "Blame"
-            old_players = self.players.copy()
-            self.players = {player:self.players[player]
-                            for player in self.players
-                            if self.players[player] not in offenders}
+            old_ring = self.ring
+            self.exclude_players(offenders)
             for offender in offenders:
                 self.messages.blame_insufficient_funds(offender)
                 self.send_message()
-                old_players_keys = list(old_players.keys())
-                old_players_vals = list(old_players.values())
-                self.logchan.send('Blame: insufficient funds of player ' +
-                                  str(old_players_keys[old_players_vals.index(offender)]))
-            if len(self.players) > 1:
-                self.number_of_players = len(self.players)
-            else:
-                self.logchan.send('Error: not enough players with sufficent funds')
+                self.log(EventKind.BLAME, 'Blame: insufficient funds of player {player}',
+                         player=old_ring.player_of(offender), recoverable=True)
+            if len(self.players) < 2:
+                self.log(EventKind.ERROR, 'Error: not enough players with sufficent funds')
                 self.done = True
                 return False
             if self.vk in offenders:
 
-                self.logchan.send('Error: players funds is not enough')
+                self.log(EventKind.ERROR, 'Error: players funds is not enough')
                 self.done = True
                 return False
             return False
 
+    def watch_coins(self):
+        """
+        Starts watching for the coins of players, so the round knows
+        if some of them disappear before the transaction is broadcasted
+        """
+        if self.watcher is None:
+            self.watcher = UnspentWatcher(self.coin)
+            self.watcher.add_listener(self.on_coins_changed)
+        self.watcher.watch(self.coin.address(self.players[player]) for player in self.players)
+
+    def on_coins_changed(self, address, removed, added):
+        """Watcher callback. Records the coins of players spent in the middle of the round"""
+        if not removed or self.done:
+            return
+        players = [player for player in self.players
+                   if self.coin.address(self.players[player]) == address]
+        self.spent_coins.extend(removed)
+        for player in players:
+            self.log_message("finds the coins of player {player} spent", player=player)
+
+    def exclude_players(self, offenders):
+        """
+        Removes offenders from the round after the blame.
+        Funds checks, verified signatures and coins of the rest of players stay valid,
+        so they are not made again
+        """
+        offenders = set(offenders)
+        self.excluded.update(offenders)
+        if self.watcher is not None:
+            self.watcher.unwatch(self.coin.address(offender) for offender in offenders)
+        self.players = {player:self.players[player]
+                        for player in self.players
+                        if self.players[player] not in offenders}
+        self.number_of_players = len(self.players)
+
+    def restart(self):
+        """
+        Starts the next try of the round without excluded players.
+        Only the cryptographically required steps are made again: the new encryption key
+        is announced and outputs are shuffled with it. Announcements of the next try
+        came in advance are kept, other frames of the failed try are dropped
+        """
+        old_keys = set(self.encryption_keys.values())
+        self.release_frames(*[state for state in PhaseType if state != PhaseType.Announcement])
+        announcements = self.inbox[PhaseType.Announcement]
+        for sender, frame in list(announcements.items()):
+            self.messages.parse(frame)
+            if self.messages.get_encryption_key() in old_keys:
+                del announcements[sender]
+        self.equivocation = None
+        self.new_addresses = set()
+        self.broadcast_new_key()
+
+    def finish_recovery(self):
+        """Measures the time to recover from the blame. It ends when keys of the next try are known"""
+        if self.blame_started is None:
+            return
+        self.recovery_time = time.time() - self.blame_started
+        self.blame_started = None
+        self.tracer.emit('recovered', duration=self.recovery_time,
+                         excluded=len(self.excluded), **self.trace_fields)
+        self.log_message("recovers from the blame in {ms:.0f} ms", ms=self.recovery_time * 1000)
+
     def broadcast_new_key(self):
         """Broadcasts the encryption keys for phase 2 (Shufflings)"""
         self.phase = 'Announcement'
@@ -231,19 +571,36 @@ class Round(object):
 
     def is_inbox_complete(self, phase):
         """Checks if inbox for the selected phase is complete"""
-        return len(self.inbox[phase]) == self.number_of_players
+        return self.inbox[phase].is_complete()
 
     def skipped_equivocation_check(self, accused):
         """Perfoms skipped equivocation check for accused player"""
-        string_to_hash = str([self.encryption_keys[self.players[i]] for i in sorted(self.players)])
+        string_to_hash = str([self.encryption_keys[key] for key in self.ring.keys])
         computed_hash = self.crypto.hash(string_to_hash)
         self.messages.blame_shuffle_failure(accused, computed_hash)
         self.phase = 'Blame'
         self.send_message()
 
+    def start_equivocation_hash(self):
+        """Starts the hash state for the equivocation check with encryption keys of players"""
+        self.equivocation = self.crypto.equivocation_hash(self.hash_version)
+        for key in self.ring.keys:
+            self.equivocation.add_key(self.encryption_keys[key])
+
+    def equivocation_hash(self):
+        """
+        Returns the hash state of encryption keys and new addresses for the equivocation check.
+        New addresses are added to the hash state only once
+        """
+        if self.equivocation is None:
+            self.start_equivocation_hash()
+        if self.equivocation.addresses is None:
+            self.equivocation.add_addresses(self.new_addresses)
+        return self.equivocation
+
     def check_for_blame(self):
         """Check for messages in blame phase inbox"""
-        return True if self.inbox[7] else False
+        return self.inbox[PhaseType.Blame].count > 0
 
     def check_reasons_and_accused(self, reason):
         """
@@ -251,12 +608,14 @@ class Round(object):
         and accused player is in the players list
         """
         if self.messages.get_blame_reason() != reason:
-            self.logchan.send("Blame: different blame reasons from players")
+            self.log(EventKind.BLAME, "Blame: different blame reasons from players",
+                     recoverable=False)
             self.done = True
             return
             # raise BlameException("Blame: different blame reasons from players")
         elif self.messages.get_accused_key in self.players.values():
-            self.logchan.send("Blame: different blame players from players")
+            self.log(EventKind.BLAME, "Blame: different blame players from players",
+                     recoverable=False)
             self.done = True
             # raise BlameException("Blame: different blame players from players")
 
@@ -266,43 +625,49 @@ class Round(object):
         cheater = None
         phase_blame = self.messages.phases["Blame"]
         for player in self.inbox[phase_blame]:
-            self.messages.packets.ParseFromString(self.inbox[phase_blame][player])
+            self.messages.parse(self.inbox[phase_blame][player])
             shufflings[player] = {}
             shufflings[player]['encryption_key'] = self.messages.get_public_key()
             shufflings[player]['decryption_key'] = self.messages.get_decryption_key()
             invalid_packets = self.messages.get_invalid_packets()
-            self.messages.packets.ParseFromString(invalid_packets)
+            self.messages.parse(invalid_packets)
             shufflings[player]['strs'] = self.messages.get_strs()
-        for player in sorted(self.players)[1:]:
-            for i in sorted(self.players):
-                if i >= player:
-                    strs = shufflings[self.players[player]]['strs']
-                    self.crypto.restore_from_privkey(shufflings[self.players[i]]['decryption_key'])
-                    shufflings[self.players[player]]['strs'] = list(map(self.crypto.decrypt, strs))
-        for pl_out, pl_in in zip(sorted(self.players)[1:-1], sorted(self.players)[2:]):
+        players = self.ring.indexes
+        # every revealed key is restored once and reused for all of its layers
+        decryptors = {i: self.crypto.decryptor(shufflings[self.players[i]]['decryption_key'])
+                      for i in players[1:]}
+        for index, player in enumerate(players[1:], 1):
+            strs = shufflings[self.players[player]]['strs']
+            for i in players[index:]:
+                strs = [self.crypto.decrypt_with(decryptors[i], s) for s in strs]
+            shufflings[self.players[player]]['strs'] = strs
+        for pl_out, pl_in in zip(players[1:-1], players[2:]):
             out_strs = set(shufflings[self.players[pl_out]]['strs'])
             in_strs = set(shufflings[self.players[pl_in]]['strs'])
             marker = len(out_strs ^ in_strs) == 1
             if not marker:
                 cheater = self.players[pl_out]
-                self.logchan.send('cheater is ' + str(pl_out))
+                self.log(EventKind.MESSAGE, 'cheater is {player}', level=Level.WARNING, player=pl_out)
                 break
         return cheater
 
     def process_announcement(self):
         """Performs announcement  phase"""
-        phase = self.messages.phases[self.phase]
+        phase = self.state
         if self.is_inbox_complete(phase):
             messages = self.inbox[phase]
             self.encryption_keys = dict()
             self.change_addresses = {}
             for message in messages:
-                self.messages.packets.ParseFromString(messages[message])
+                self.messages.parse(messages[message])
                 from_key = self.messages.get_from_key()
                 self.encryption_keys[from_key] = self.messages.get_encryption_key()
                 self.change_addresses[from_key] = self.messages.get_address()
             if len(self.encryption_keys) == self.number_of_players:
                 self.log_message("recieved all keys for test")
+                self.finish_recovery()
+                self.start_equivocation_hash()
+                self.request_skeleton()
                 self.phase = 'Shuffling'
                 self.log_message("reaches phase 2")
                 self.messages.clear_packets()
@@ -314,11 +679,11 @@ class Round(object):
 
     def process_shuffling(self):
         """Performs shuffling phase"""
-        phase = self.messages.phases[self.phase]
+        phase = self.state
         if self.me == self.last_player():
             sender = self.players[self.previous_player(player=self.last_player())]
             if self.inbox[phase].get(sender):
-                self.messages.packets.ParseFromString(self.inbox[phase][sender])
+                self.messages.parse(self.inbox[phase][sender])
                 for packet in self.messages.packets.packet:
                     packet.packet.message.str = self.crypto.decrypt(packet.packet.message.str)
                 self.messages.add_str(self.addr_new)
@@ -329,7 +694,7 @@ class Round(object):
         else:
             sender = self.players[self.previous_player()]
             if self.inbox[phase].get(sender):
-                self.messages.packets.ParseFromString(self.inbox[phase][sender])
+                self.messages.parse(self.inbox[phase][sender])
                 for packet in self.messages.packets.packet:
                     packet.packet.message.str = self.crypto.decrypt(packet.packet.message.str)
                 if self.different_ciphertexts():
@@ -340,45 +705,41 @@ class Round(object):
                     self.phase = 'BroadcastOutput'
                 else:
                     self.skipped_equivocation_check(sender)
-                    self.log_message("wrong from " + str(sender))
+                    self.log_message("wrong from {sender}", sender=sender)
 
     def process_broadcast_output(self):
         """
         Performs broadcast output phase
         """
-        phase = self.messages.phases[self.phase]
+        phase = self.state
         sender = self.players[self.last_player()]
         if self.inbox[phase].get(sender):
-            self.messages.packets.ParseFromString(self.inbox[phase][sender])
+            self.messages.parse(self.inbox[phase][sender])
             self.new_addresses = self.messages.get_new_addresses()
             if self.addr_new in self.new_addresses:
                 self.log_message("receive addresses and found itsefs")
             else:
-                self.logchan.send("Blame: Player " + str(self.me) +
-                                  "  not found itselfs new address")
+                self.log(EventKind.BLAME, "Blame: Player {me}  not found itselfs new address",
+                         me=self.me, recoverable=False)
                 self.skipped_equivocation_check(sender)
                 return
             self.phase = 'EquivocationCheck'
             self.log_message("reaches phase 4")
-            computed_hash = self.crypto.hash(str(self.new_addresses) +
-                                             str([self.encryption_keys[self.players[i]]
-                                                  for i in sorted(self.players)]))
+            computed_hash = self.equivocation_hash().digest(self.hash_version)
             self.messages.clear_packets()
             self.messages.add_hash(computed_hash)
             self.send_message()
 
     def process_equivocation_check(self):
         """Performs equivoication phase check"""
-        phase = self.messages.phases[self.phase]
-        computed_hash = self.crypto.hash(str(self.new_addresses) +
-                                         str([self.encryption_keys[self.players[i]]
-                                              for i in sorted(self.players)]))
+        phase = self.state
         if self.is_inbox_complete(phase):
+            equivocation = self.equivocation_hash()
             messages = self.inbox[phase]
             for player in messages:
-                self.messages.packets.ParseFromString(messages[player])
+                self.messages.parse(messages[player])
                 hash_value = self.messages.get_hash()
-                if hash_value != computed_hash:
+                if not equivocation.matches(hash_value):
                     phase1 = self.messages.phases["Announcement"]
                     phase3 = self.messages.phases["BroadcastOutput"]
                     phase1_packets = b"".join(list(self.inbox[phase1].values()))
@@ -387,57 +748,132 @@ class Round(object):
                     self.messages.blame_equivocation_failure(player, invalid_packets=for_send)
                     self.phase = "Blame"
                     self.send_message()
-                    cheater = [p for p in self.players if self.players[p] == player][0]
-                    self.log_message("find bad hash from " +str(cheater))
-                    self.logchan.send('Blame: wrong hash computed by player ' + str(cheater))
+                    cheater = self.player_of(player)
+                    self.log_message("find bad hash from {player}", player=cheater)
+                    self.log(EventKind.BLAME, 'Blame: wrong hash computed by player {player}',
+                             player=cheater, recoverable=True)
                     return
+            # everyone has the same hash, so no blame needs the frames of previous phases
+            self.release_frames(PhaseType.Announcement, PhaseType.Shuffling,
+                                PhaseType.BroadcastOutput, PhaseType.EquivocationCheck)
             self.phase = 'VerificationAndSubmission'
             self.log_message("reaches phase 5")
-            inputs = {self.players[player]:self.coin.address(self.players[player])
-                      for player in self.players}
-            self.transaction = self.coin.make_unsigned_transaction(self.amount,
-                                                                   self.fee,
-                                                                   inputs,
-                                                                   self.new_addresses,
-                                                                   self.change_addresses)
+            self.transaction = self.make_transaction()
             if self.transaction == None:
-                self.logchan.send("Error: blockchain network fault!")
+                self.log(EventKind.ERROR, "Error: blockchain network fault!")
                 self.done = True
                 return
+            start = time.thread_time()
             signature = self.coin.get_transaction_signature(self.transaction, self.sk, self.vk)
+            self.signing_time = time.thread_time() - start
+            self.log_message("spent {ms:.3f} ms of cpu time on signing", ms=self.signing_time * 1000)
             self.messages.clear_packets()
             self.messages.add_signature(signature)
             self.send_message()
             self.log_message("send transction signature")
 
+    def request_skeleton(self):
+        """
+        Starts making of transaction inputs and change outputs in background.
+        They are known after the announcement, so network requests and inputs assembling
+        go while players shuffle the outputs
+        """
+        inputs = {self.players[player]:self.coin.address(self.players[player])
+                  for player in self.players}
+        changes = dict(self.change_addresses)
+        skeleton = self.reusable_skeleton(inputs, changes)
+        if skeleton is not None:
+            self.skeleton_future = Future()
+            self.skeleton_future.set_result(skeleton)
+        else:
+            self.skeleton_future = self.async_coin.submit(self.make_skeleton, inputs, changes)
+        self.skeleton_request = (inputs, changes)
+
+    def make_skeleton(self, inputs, changes):
+        """
+        Makes the transaction skeleton in background. Coins of players were prefetched
+        when the keys were gathered, so it waits until the watcher loaded them again;
+        coins spent since the prefetch are dropped by the watcher then
+        """
+        if self.watcher is not None:
+            self.watcher.wait_loaded(inputs.values(), timeout=self.async_coin.timeout)
+        return self.coin.make_transaction_skeleton(self.amount, self.fee, inputs, changes)
+
+    def spends_spent_coins(self, skeleton):
+        """Checks if the skeleton has inputs the watcher has seen spent"""
+        spent = {UnspentWatcher.outpoint(utxo) for utxo in self.spent_coins}
+        return any((txin['prevout_hash'], txin['prevout_n']) in spent for txin in skeleton.inputs)
+
+    def reusable_skeleton(self, inputs, changes):
+        """
+        Returns the skeleton of the failed try without excluded players if it is still valid,
+        i.e. the rest of players have the same addresses, change addresses and unspent coins.
+        Returns None otherwise
+        """
+        if self.skeleton_request is None:
+            return None
+        # request in progress is waited for, it is still cheaper than the new one
+        skeleton = self.async_coin.result(self.skeleton_future)
+        old_inputs, old_changes = self.skeleton_request
+        if skeleton is None or any(old_inputs.get(key) != inputs[key] or
+                                   old_changes.get(key) != changes.get(key)
+                                   for key in inputs):
+            return None
+        if self.spends_spent_coins(skeleton):
+            return None
+        return skeleton.without(set(old_inputs) - set(inputs))
+
+    def make_transaction(self):
+        """
+        Completes the transaction skeleton with the shuffled outputs.
+        Returns None if network fails
+        """
+        if self.skeleton_future is None:
+            self.request_skeleton()
+        skeleton = self.async_coin.result(self.skeleton_future)
+        if skeleton is not None and self.spends_spent_coins(skeleton):
+            # the coin was spent after the skeleton was made, the address could have another one
+            self.skeleton_request = None
+            self.request_skeleton()
+            skeleton = self.async_coin.result(self.skeleton_future)
+        if skeleton is None:
+            return None
+        return self.coin.complete_transaction(skeleton, self.amount, self.new_addresses)
+
     def process_verification_and_submission(self):
         """Perform verification and submission phase"""
-        phase = self.messages.phases[self.phase]
+        phase = self.state
         if self.is_inbox_complete(phase):
             self.signatures = {}
             self.log_message("got transction signatures")
             for player in self.players:
-                self.messages.packets.ParseFromString(self.inbox[phase][self.players[player]])
-                player_signature = self.messages.get_signature()
-                self.signatures[self.players[player]] = player_signature
-                check = self.coin.verify_tx_signature(player_signature,
-                                                      self.transaction,
-                                                      self.players[player])
-                if not check:
-                    self.messages.blame_wrong_transaction_signature(self.players[player])
-                    self.send_message()
-                    self.logchan.send('Blame: wrong transaction signature from player ' +
-                                      str(player))
-                    self.done = True
-                    return
-                    # raise BlameException('Wrong tx signature from player ' + str(player))
+                self.messages.parse(self.inbox[phase][self.players[player]])
+                self.signatures[self.players[player]] = self.messages.get_signature()
+            wrong_signatures = self.coin.verify_tx_signatures(self.signatures, self.transaction)
+            if wrong_signatures:
+                offender = wrong_signatures[0]
+                player = self.player_of(offender)
+                self.messages.blame_wrong_transaction_signature(offender)
+                self.send_message()
+                self.log(EventKind.BLAME, 'Blame: wrong transaction signature from player {player}',
+                         player=player, recoverable=False)
+                self.done = True
+                return
+                # raise BlameException('Wrong tx signature from player ' + str(player))
             self.coin.add_transaction_signatures(self.transaction, self.signatures)
-            msg, status = self.coin.broadcast_transaction(self.transaction)
+            # the broadcaster has its own deadline for all of the servers and retries
+            msg, status = self.async_coin.result(
+                self.async_coin.broadcast_transaction(self.transaction),
+                timeout=self.coin.broadcaster.timeout, default=(None, None))
             if msg == None and status == None:
-                self.logchan.send("Error: blockchain network fault!")
+                self.log(EventKind.ERROR, "Error: blockchain network fault!")
             else:
-                self.log_message(str(status))
-                self.log_message("complete protocol")
+                self.broadcast_time = self.coin.broadcaster.metrics.get('time_to_broadcast')
+                if self.broadcast_time is not None:
+                    self.log_message("spent {ms:.0f} ms on broadcasting", ms=self.broadcast_time * 1000)
+                self.log_message("{status}", status=status)
+                self.log_message("complete protocol", kind=EventKind.COMPLETE,
+                                 txid=status if msg else None)
                 self.tx = self.transaction
             self.done = True
 
@@ -446,11 +882,10 @@ class Round(object):
         messages = self.inbox[phase]
         if self.is_inbox_complete(phase):
             for sender in messages:
-                self.messages.packets.ParseFromString(messages[sender])
+                self.messages.parse(messages[sender])
                 self.check_reasons_and_accused(reason)
             self.ban_the_liar(self.messages.get_accused_key())
-            self.inbox[self.messages.phases["Blame"]] = {}
-            self.broadcast_new_key()
+            self.restart()
 
     def process_blame_equivocation_failure(self, phase, reason):
         """Performs the Blame phase in the case of equivocation failure"""
@@ -460,10 +895,10 @@ class Round(object):
         new_addresses_matrix = {key:set() for key in self.players.values()}
         if self.is_inbox_complete(phase):
             for sender in messages:
-                self.messages.packets.ParseFromString(messages[sender])
+                self.messages.parse(messages[sender])
                 self.check_reasons_and_accused(reason)
                 invalid_packets = self.messages.get_invalid_packets()
-                self.messages.packets.ParseFromString(invalid_packets)
+                self.messages.parse(invalid_packets)
                 self.check_for_signatures()
                 for packet in self.messages.packets.packet:
                     if packet.packet.phase == 1:
@@ -481,29 +916,11 @@ class Round(object):
             if len(set(new_addresses_matrix.values())) > 1:
                 all_cheaters.append(self.players[self.last_player()])
             if len(all_cheaters) > 0:
-                self.players = {player:self.players[player]
-                                for player in self.players
-                                if self.players[player] not in all_cheaters}
-                self.number_of_players = len(self.players)
-                for phase in self.messages.phases:
-                    if phase != "Announcement":
-                        self.inbox[self.messages.phases[phase]] = {}
-                phase_1 = self.messages.phases["Announcement"]
-                self.inbox[phase_1] = {key:self.inbox[phase_1][key]
-                                       for key in self.inbox[phase_1]
-                                       if key not in all_cheaters}
-                phase1_packets = self.inbox[phase_1].copy()
-                encryption_keys = list(self.encryption_keys.values())
-                for message in phase1_packets:
-                    self.messages.packets.ParseFromString(phase1_packets[message])
-                    ec = self.messages.get_encryption_key()
-                    if ec in encryption_keys:
-                        del self.inbox[phase_1][message]
+                self.exclude_players(all_cheaters)
                 for player in all_cheaters:
                     self.ban_the_liar(player)
                 if self.vk not in all_cheaters:
-                    self.inbox[self.messages.phases["Blame"]] = {}
-                    self.broadcast_new_key()
+                    self.restart()
 
     def process_blame_shuffle_failure(self, phase, reason):
         """Performs the blame phase in a case of shuffle failure"""
@@ -514,7 +931,7 @@ class Round(object):
         elif self.is_inbox_complete(phase_blame):
             hashes = set()
             for player in self.inbox[phase_blame]:
-                self.messages.packets.ParseFromString(self.inbox[phase_blame][player])
+                self.messages.parse(self.inbox[phase_blame][player])
                 hashes.add(self.messages.get_hash())
             if len(hashes) == 1:
                 accused = self.messages.get_accused_key()
@@ -527,9 +944,9 @@ class Round(object):
                                                                      dc,
                                                                      phase2_packets)
                 self.send_message()
-                self.inbox[phase_blame] = {}
+                self.inbox[phase_blame].clear()
             else:
-                self.logchan.send("Erorr: different hashes appears")
+                self.log(EventKind.ERROR, "Error: different hashes appear")
                 self.done = True
                 return
                 # raise 'Blame!'
@@ -542,16 +959,12 @@ class Round(object):
             if cheater:
                 if cheater != self.vk:
                     self.ban_the_liar(cheater)
-                    self.players = {player:self.players[player]
-                                    for player in self.players
-                                    if self.players[player] != cheater}
-                    self.number_of_players = len(self.players)
-                    self.inbox = {self.messages.phases[phase]:{} for phase in self.messages.phases}
-                    self.broadcast_new_key()
+                    self.exclude_players([cheater])
+                    self.restart()
 
     def process_blame(self):
         """Chooses the case for blame phase"""
-        phase = self.messages.phases[self.phase]
+        phase = self.state
         reason = self.messages.get_blame_reason()
         br = self.messages.blame_reason
         {
@@ -562,25 +975,57 @@ class Round(object):
         }[reason](phase, reason)
 
     def process_inbox(self):
-        """Check what is come to inbox and what to do with it"""
-        if self.check_for_blame():
-            self.process_blame()
-        else:
-            {'Announcement' : self.process_announcement,
-             'Shuffling' : self.process_shuffling,
-             'BroadcastOutput' : self.process_broadcast_output,
-             'EquivocationCheck' : self.process_equivocation_check,
-             'VerificationAndSubmission' : self.process_verification_and_submission,
-             'Blame' : self.process_blame
-            }[self.phase]()
+        """
+        Check what is come to inbox and what to do with it.
+        Blame frames go to the blame handler. Other frames wake up the handler
+        of current phase only if they belong to it. If handler moves the round to
+        the next phase, the next handler runs at once on frames came in advance
+        """
+        frame_phase = self.frame_phase
+        if frame_phase == PhaseType.Blame:
+            state = self.state
+            if self.tracer.enabled:
+                with self.tracer.span('handler', phase='Blame', **self.trace_fields):
+                    self.process_blame()
+            else:
+                self.process_blame()
+            # the next try could be started by blame
+            if self.state is not state and not self.check_for_blame():
+                self.run_handlers()
+        elif frame_phase == self.state and not self.check_for_blame():
+            self.run_handlers()
+
+    def run_handlers(self):
+        """
+        Runs handlers of current phase until the phase stops changing.
+        It runs for every received frame, so spans are made only if tracing is on
+        """
+        handlers = self.handlers
+        tracer = self.tracer if self.tracer.enabled else None
+        while not self.done:
+            state = self.state
+            if tracer is None:
+                handlers[state]()
+            else:
+                with tracer.span('handler', phase=state.name, **self.trace_fields):
+                    handlers[state]()
+            if self.state is state or self.state is PhaseType.Blame or self.check_for_blame():
+                break
 
     def protocol_loop(self):
         """Main protocol loop"""
         assert (self.amount > 0), "Wrong amount for transction"
-        self.log_message("begins CoinShuffle protocol " + " with " +
-                         str(self.number_of_players) + " players.")
+        self.log_message("begins CoinShuffle protocol  with {number} players.",
+                         kind=EventKind.START, number=self.number_of_players)
         if self.blame_insufficient_funds():
             self.broadcast_new_key()
         while not self.done:
             if self.inchan_to_inbox():
                 self.process_inbox()
+        self.async_coin.shutdown()
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.counters.enabled:
+            self.tracer.emit('op_counters', counts=self.counters.summary(), **self.trace_fields)
+            self.log_message("made operations {totals}", kind=EventKind.MESSAGE,
+                             totals=self.counters.totals())
@@ -2,6 +2,7 @@ import socket
 import ssl
 import threading
 import queue
+from .events import EventKind, Level, LogEvent
 
 class Channel(queue.Queue):
     "simple Queue wrapper for using recv and send"
@@ -27,7 +28,7 @@ class ChannelWithPrint(queue.Queue):
 class Commutator(threading.Thread):
     """Class for decoupling of send and recv ops."""
     def __init__(self, income, outcome, logger=ChannelWithPrint(),
-                 buffsize=4096, timeout=0, switch_timeout=0.0, ssl=False):
+                 buffsize=4096, timeout=0, switch_timeout=0.0, ssl=False, log_level=Level.INFO):
         super(Commutator, self).__init__()
         self.income = income
         self.outcome = outcome
@@ -40,10 +41,12 @@ class Commutator(threading.Thread):
         self.timeout = timeout
         self.switch_timeout = switch_timeout
         self.ssl = ssl
+        # debug events of every frame are made only if log_level allows them
+        self.log_level = log_level
 
     def debug(self, obj):
-        if self.logger:
-            self.logger.put(str(obj))
+        if self.logger and self.log_level <= Level.DEBUG:
+            self.logger.put(LogEvent(EventKind.DEBUG, '{obj}', obj=obj))
 
     def run(self):
         while self.alive.isSet():
@@ -79,7 +82,7 @@ class Commutator(threading.Thread):
             self.socket.connect((host, port))
             self.debug('connected')
         except IOError as e:
-            self.logger.put(str(e))
+            self.logger.put(LogEvent(EventKind.MESSAGE, '{error}', level=Level.ERROR, error=e))
             raise e
 
     def _send(self, msg):
@@ -1,12 +1,15 @@
 import hashlib
+import struct
 import ecdsa
 from ecdsa.util import number_to_string, string_to_number
 from electroncash.bitcoin import (generator_secp256k1, point_to_ser, EC_KEY)
+from .tracing import null_counters
 
 class Crypto(object):
     """
     This class used for tasks related to cryptography
     """
+    counters = null_counters
 
     def __init__(self):
         self.G = generator_secp256k1
@@ -17,6 +20,8 @@ class Crypto(object):
         self.private_key = ecdsa.util.randrange(pow(2, 256)) % self._r
         self.eck = EC_KEY(number_to_string(self.private_key, self._r))
         self.public_key = point_to_ser(self.private_key*self.G, True)
+        # the public key here and the one of EC_KEY
+        self.counters.count('ec_mult', 2)
 
     def export_private_key(self):
         "Export private key as hex string"
@@ -30,6 +35,15 @@ class Crypto(object):
         self.private_key = string_to_number(bytes.fromhex(secret_string))
         self.eck = EC_KEY(bytes.fromhex(secret_string))
         self.public_key = point_to_ser(self.private_key*self.G, True)
+        self.counters.count('ec_mult', 2)
+
+    def decryptor(self, secret_string):
+        """
+        make standalone key object from private key expressed in a hex form.
+        Unlike restore_from_privkey it keeps own key pair untouched
+        """
+        self.counters.count('ec_mult')
+        return EC_KEY(bytes.fromhex(secret_string))
 
     def export_public_key(self):
         """
@@ -39,15 +53,117 @@ class Crypto(object):
 
     def encrypt(self, message, pubkey):
         "encrypt message with pubkey"
+        self.counters.count('ecies_encrypt')
         res = self.eck.encrypt_message(message.encode('utf-8'), bytes.fromhex(pubkey))
         return res.decode('utf-8')
 
     def decrypt(self, message):
         "decrypt message"
+        self.counters.count('ecies_decrypt')
         return self.eck.decrypt_message(message)
 
+    def decrypt_with(self, eck, message):
+        "decrypt message with key object made by decryptor"
+        self.counters.count('ecies_decrypt')
+        return eck.decrypt_message(message)
+
     def hash(self, text, algorithm='sha224'):
         "method for hashing the text"
+        self.counters.count('hash')
         h = hashlib.new(algorithm)
         h.update(text.encode('utf-8'))
         return h.digest()
+
+    def equivocation_hash(self, version=None):
+        "makes new hash state for the equivocation check, version is the hash to send"
+        if version is None:
+            version = EquivocationHash.LEGACY
+        return EquivocationHash(self.counters, version)
+
+
+class EquivocationHash(object):
+    """
+    This class computes the hash of encryption keys and new addresses for the
+    equivocation check. Keys and addresses are fed as they become known.
+
+    Two hash versions are supported:
+        LEGACY - sha224 over python representation of addresses and keys lists
+        CANONICAL - sha256 over length-prefixed encoding of keys and addresses,
+                    prefixed with the version byte
+    The version of received hash is recognized by its format, so players
+    with different versions still can check each other. Only the hash of
+    the selected version is fed as values come, the other one is computed
+    from the stored keys and addresses if a player sends it.
+    """
+    LEGACY = 0
+    CANONICAL = 1
+
+    def __init__(self, counters=null_counters, version=LEGACY):
+        self.counters = counters
+        self.version = version
+        self.keys = []
+        self.addresses = None
+        self.canonical = self.new_canonical() if version == self.CANONICAL else None
+        self.digests = {}
+
+    @staticmethod
+    def new_canonical():
+        return hashlib.sha256(b'CashShuffle equivocation check')
+
+    @staticmethod
+    def encode(value):
+        "length-prefixed encoding of the string value"
+        data = value.encode('utf-8') if isinstance(value, str) else bytes(value)
+        return struct.pack('>I', len(data)) + data
+
+    def add_key(self, key):
+        "adds the encryption key of the next player (players go in sorted order)"
+        assert self.addresses is None, 'Keys should be added before addresses'
+        self.keys.append(key)
+        if self.canonical is not None:
+            self.canonical.update(self.encode(key))
+
+    def add_addresses(self, addresses):
+        "adds the new addresses from the broadcast output"
+        assert self.addresses is None, 'Addresses are already added'
+        self.addresses = list(addresses)
+        if self.canonical is not None:
+            self.update_addresses(self.canonical)
+
+    def update_addresses(self, canonical):
+        canonical.update(struct.pack('>II', len(self.keys), len(self.addresses)))
+        for address in self.addresses:
+            canonical.update(self.encode(address))
+
+    def canonical_digest(self):
+        "digest of the canonical hash, it is computed from scratch if it was not fed"
+        canonical = self.canonical
+        if canonical is None:
+            canonical = self.new_canonical()
+            for key in self.keys:
+                canonical.update(self.encode(key))
+            self.update_addresses(canonical)
+        return bytes([self.CANONICAL]) + canonical.digest()
+
+    @classmethod
+    def version_of(cls, hash_value):
+        "recognizes the version of hash value"
+        if len(hash_value) == 33 and hash_value[0] == cls.CANONICAL:
+            return cls.CANONICAL
+        return cls.LEGACY
+
+    def digest(self, version=LEGACY):
+        "returns the hash value of selected version"
+        assert self.addresses is not None, 'Addresses should be added first'
+        if version not in self.digests:
+            self.counters.count('hash')
+            if version == self.CANONICAL:
+                self.digests[version] = self.canonical_digest()
+            else:
+                text = str(self.addresses) + str(self.keys)
+                self.digests[version] = hashlib.sha224(text.encode('utf-8')).digest()
+        return self.digests[version]
+
+    def matches(self, hash_value):
+        "checks received hash value against the hash of the same version"
+        return hash_value == self.digest(self.version_of(hash_value))
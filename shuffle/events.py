@@ -0,0 +1,71 @@
+from enum import Enum, IntEnum
+
+class Level(IntEnum):
+    """Levels of log events, the same numbers as levels of the logging module"""
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+class EventKind(Enum):
+    """Kinds of log events, consumers act on them instead of parsing the text"""
+    MESSAGE = 'message' # any other message
+    PROGRESS = 'progress' # player makes the next step of the protocol
+    START = 'start' # protocol round is started
+    COMPLETE = 'complete' # transaction is broadcasted
+    BLAME = 'blame' # player is blamed, recoverable field tells if the round goes on
+    ERROR = 'error' # round is stopped
+    DEBUG = 'debug'
+
+LEVELS = {
+    EventKind.BLAME: Level.WARNING,
+    EventKind.ERROR: Level.ERROR,
+    EventKind.DEBUG: Level.DEBUG,
+}
+
+class LogEvent(object):
+    """
+    Structured event of the protocol log.
+
+    The text is formatted from template and fields only when someone reads it,
+    so events nobody prints cost nothing but the object. Consumers which work
+    with the text take it by str(event).
+    """
+    __slots__ = ('kind', 'level', 'template', 'fields', '_text')
+
+    def __init__(self, kind, template, level=None, **fields):
+        self.kind = kind
+        self.level = LEVELS.get(kind, Level.INFO) if level is None else level
+        self.template = template
+        self.fields = fields
+        self._text = None
+
+    @classmethod
+    def of(cls, message):
+        """
+        Returns message as the event. Plain strings of old producers are classified
+        by their prefixes, as consumers did before
+        """
+        if isinstance(message, LogEvent):
+            return message
+        message = str(message)
+        if message.startswith('Error'):
+            return cls(EventKind.ERROR, message)
+        if message.startswith('Blame'):
+            recoverable = 'insufficient' in message or 'wrong hash' in message
+            return cls(EventKind.BLAME, message, recoverable=recoverable)
+        if message.endswith('complete protocol'):
+            return cls(EventKind.COMPLETE, message)
+        return cls(EventKind.MESSAGE, message)
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.template.format(**self.fields) if self.fields else self.template
+        return self._text
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return 'LogEvent({}, {!r})'.format(self.kind.name, self.text)
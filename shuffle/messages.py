@@ -1,8 +1,10 @@
 from . import message_pb2 as message_factory
 
 from random import shuffle
+from .tracing import null_counters
 
 class Messages(object):
+    counters = null_counters
 
     def check_for_length(f):
         "Wrapper for number of packets in message"
@@ -41,7 +43,7 @@ class Messages(object):
         packet.packet.from_key.key = verification_key
         packet.packet.registration.amount = amount
 
-    def form_all_packets(self, eck, session, number, vk_from, vk_to, phase):
+    def form_all_packets(self, eck, session, number, vk_from, vk_to, phase, compressed=None):
         """
         This method forms a packet to send
 
@@ -51,10 +53,10 @@ class Messages(object):
         vk_from - sender verification key
         vk_to - receiver verification key (None for broadcasted messages)
         phase - phase of the protocol
+        compressed - compression flag of sender key (default is taken from vk_from)
         """
-        compressed = True
-        if vk_from.startswith("04"):
-            compressed = False
+        if compressed is None:
+            compressed = not vk_from.startswith("04")
         for packet in self.packets.packet:
             packet.packet.session = session
             packet.packet.phase = self.phases.get(phase)
@@ -68,6 +70,9 @@ class Messages(object):
                 packet.packet.ClearField('to_key')
             msg = packet.packet.SerializeToString()
             packet.signature.signature = eck.sign_message(msg, compressed)
+            self.counters.count('pb_serialize')
+            self.counters.count('hash')
+            self.counters.count('ecdsa_sign')
 
     def general_blame(self, reason, accused):
         """
@@ -256,6 +261,7 @@ class Messages(object):
 
     def get_signatures_and_packets(self):
         "gets signatures and packets"
+        self.counters.count('pb_serialize', len(self.packets.packet))
         return [[packet.signature.signature,
                  packet.packet.SerializeToString(),
                  packet.packet.from_key.key]
@@ -274,6 +280,16 @@ class Messages(object):
         "gets strs values from the packets"
         return [packet.packet.message.str for packet in self.packets.packet]
 
+    def parse(self, frame):
+        "parses the frame to packets"
+        self.counters.count('pb_parse')
+        self.packets.ParseFromString(frame)
+
+    def serialize(self):
+        "serializes packets to the frame"
+        self.counters.count('pb_serialize')
+        return self.packets.SerializeToString()
+
     def clear_packets(self):
         "clear the packets"
         self.__init__()
@@ -1,13 +1,40 @@
+from enum import IntEnum
+
+class PhaseType(IntEnum):
+    """
+    Phases of the protocol. Values are the same as the phase numbers of
+    protobuf packets, so they can be compared with the received phase directly
+    """
+    Announcement = 1 # Everone generates new encryption keys and distributes them to one another.
+    Shuffling = 2 # In turn, each of the players adds his own new address and reshufles the result.
+    BroadcastOutput = 3 # The final output order is broadcast to everyone.
+    EquivocationCheck = 4 # Check that everyone has the same set of inputs.
+    Signing = 5
+    VerificationAndSubmission = 6 # Generate transaction, distribute signatures, and send it off.
+    Blame = 7
+
+# Allowed transitions of the Round state machine.
+# Blame can happen at any moment and new announcement starts the next try after the blame
+TRANSITIONS = {
+    None: frozenset(PhaseType),
+    PhaseType.Announcement: frozenset([PhaseType.Announcement, PhaseType.Shuffling,
+                                       PhaseType.BroadcastOutput, PhaseType.Blame]),
+    PhaseType.Shuffling: frozenset([PhaseType.Announcement, PhaseType.BroadcastOutput,
+                                    PhaseType.Blame]),
+    PhaseType.BroadcastOutput: frozenset([PhaseType.Announcement, PhaseType.EquivocationCheck,
+                                          PhaseType.Blame]),
+    PhaseType.EquivocationCheck: frozenset([PhaseType.Announcement,
+                                            PhaseType.VerificationAndSubmission,
+                                            PhaseType.Blame]),
+    PhaseType.Signing: frozenset([PhaseType.Announcement, PhaseType.VerificationAndSubmission,
+                                  PhaseType.Blame]),
+    PhaseType.VerificationAndSubmission: frozenset([PhaseType.Announcement, PhaseType.Blame]),
+    PhaseType.Blame: frozenset([PhaseType.Announcement, PhaseType.Blame]),
+}
+
 class Phase(object):
 
-    phases = frozenset([
-      'Announcement', # Everone generates new encryption keys and distributes them to one another.
-      'Shuffling', # In turn, each of the players adds his own new address and reshufles the result.
-      'BroadcastOutput', # The final output order is broadcast to everyone.
-      'EquivocationCheck', # Check that everyone has the same set of inputs.
-      'Signing',
-      'VerificationAndSubmission', # Generate transaction, distribute signatures, and send it off.
-      'Blame'])
+    phases = frozenset(PhaseType.__members__)
 
     def __init__(self):
         self.__phase = 'Uninitiated'
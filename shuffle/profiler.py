@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+class SamplingProfiler(object):
+    """
+    Sampling profiler of the chosen threads of the process.
+
+    The own daemon thread wakes up every interval seconds and takes the stacks
+    of the chosen threads with sys._current_frames. The same stacks are
+    counted once, so the memory does not grow with the time of profiling.
+    Stacks are written in the collapsed format "thread;outer;...;inner count"
+    which is read by flamegraph.pl, speedscope and inferno.
+
+    threads is a callable returning {name: thread}. It is called for every
+    sample, so threads started after the profiler are sampled too.
+    """
+
+    def __init__(self, threads, interval=0.005):
+        self.threads = threads
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.labels = {}
+        self.started = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, name='SamplingProfiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def label(self, code):
+        "name of the frame in the stack, it is made once per code object"
+        label = self.labels.get(code)
+        if label is None:
+            label = "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                        code.co_firstlineno)
+            self.labels[code] = label
+        return label
+
+    def sample(self):
+        "takes stacks of the chosen threads"
+        frames = sys._current_frames()
+        for name, thread in self.threads().items():
+            frame = frames.get(getattr(thread, 'ident', None))
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.append(name)
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        "returns the lines of collapsed stacks"
+        return ["{} {}".format(stack, count) for stack, count in sorted(self.stacks.items())]
+
+    def write(self, path):
+        "writes collapsed stacks to the file, directories are made if needed"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+        return path
@@ -38,12 +38,17 @@ from PyQt5.QtWidgets import (QVBoxLayout, QLabel, QGridLayout, QLineEdit, QHBoxL
 
 from electroncash.plugins import BasePlugin, hook
 from electroncash.i18n import _
+from electroncash.address import Address
 from electroncash_gui.qt.util import EnterButton, Buttons, CloseButton
 from electroncash_gui.qt.util import OkButton, WindowModalDialog
 from .shuffle import InputAdressWidget, ChangeAdressWidget, OutputAdressWidget, ConsoleOutput, AmountSelect, ServersList
+from .coin import Coin, UnspentWatcher
+from .events import EventKind
 
 class ShuffleWidget(QWidget):
 
+    coins_changed = pyqtSignal()
+
     def __init__(self, window):
         QWidget.__init__(self)
         self.window = window
@@ -51,8 +56,12 @@ class ShuffleWidget(QWidget):
         self.update_inputs_timer = QtCore.QTimer()
         self.waiting_timeout = 180
         self.timer.timeout.connect(self.tick)
+        # inputs are updated on address status notifications,
+        # the timer is only a fallback for the missed ones
+        self.watcher = None
+        self.coins_changed.connect(self.update_inputs)
         self.update_inputs_timer.timeout.connect(self.update_inputs)
-        self.update_inputs_timer.start(15000)
+        self.update_inputs_timer.start(60000)
         self.coinshuffle_fee_constant = 1000
         # This is for debug
         # self.coinshuffle_fee_constant = 1000
@@ -114,6 +123,19 @@ class ShuffleWidget(QWidget):
         if not self.coinshuffle_cancel_button.isEnabled():
             self.coinshuffle_inputs.update(self.window.wallet)
             self.coinshuffle_outputs.update(self.window.wallet)
+        self.watch_inputs()
+
+    def watch_inputs(self):
+        "subscribes to the status changes of the input addresses"
+        if self.window.network is None:
+            return
+        if self.watcher is None:
+            self.watcher = UnspentWatcher(Coin(self.window.network))
+            # listeners are called from the watcher thread
+            self.watcher.add_listener(lambda address, removed, added: self.coins_changed.emit())
+        # addresses which have no coins anymore are unwatched
+        self.watcher.watch_only([utxo['address'].to_string(Address.FMT_LEGACY)
+                                 for utxo in self.window.wallet.get_utxos()])
 
     def tick(self):
         self.waiting_timeout -= 1
@@ -161,8 +183,9 @@ class ShuffleWidget(QWidget):
         self.coinshuffle_amount_radio.setEnabled(False)
 
 
-    def process_protocol_messages(self, message):
-        if message.startswith("Error"):
+    def process_protocol_messages(self, event):
+        message = str(event)
+        if event.kind == EventKind.ERROR:
             self.pThread.join()
             self.coinshuffle_text_output.setTextColor(QColor('red'))
             self.coinshuffle_text_output.append(message)
@@ -170,8 +193,10 @@ class ShuffleWidget(QWidget):
             self.coinshuffle_cancel_button.setEnabled(False)
             self.coinshuffle_inputs.update(self.window.wallet)
             self.coinshuffle_outputs.update(self.window.wallet)
+            # the round is over, its coins do not need the subscriptions anymore
+            self.watch_inputs()
             self.timer.stop()
-        elif message[-17:] == "complete protocol":
+        elif event.kind == EventKind.COMPLETE:
             self.coinshuffle_text_output.append(message)
             self.pThread.done.set()
             tx = self.pThread.protocol.tx
@@ -183,21 +208,18 @@ class ShuffleWidget(QWidget):
             self.coinshuffle_cancel_button.setEnabled(False)
             self.coinshuffle_inputs.update(self.window.wallet)
             self.coinshuffle_outputs.update(self.window.wallet)
-        elif "begins" in message:
+            # the round is over, its coins do not need the subscriptions anymore
+            self.watch_inputs()
+        elif event.kind == EventKind.START:
             self.timer.stop()
             self.coinshuffle_timer_output.setText("")
             self.waiting_timeout = 180
         else:
-            header = message[:6]
-            if header == 'Player':
+            if event.kind == EventKind.PROGRESS:
                 self.coinshuffle_text_output.setTextColor(QColor('green'))
-            if header[:5] == 'Blame':
+            if event.kind == EventKind.BLAME:
                 self.coinshuffle_text_output.setTextColor(QColor('red'))
-                if "insufficient" in message:
-                    pass
-                elif "wrong hash" in message:
-                    pass
-                else:
+                if not event.fields.get('recoverable'):
                     self.pThread.join()
                     self.enable_coinshuffle_settings()
                     self.coinshuffle_text_output.append(str(self.pThread.isAlive()))
@@ -32,6 +32,7 @@ from PyQt5.QtGui import *
 from electroncash_gui.qt.util import *
 from electroncash.i18n import _
 from .client import ProtocolThread
+from .events import LogEvent
 
 class AmountSelect(QGroupBox):
 
@@ -152,13 +153,14 @@ class OutputAdressWidget(QComboBox):
 
 
 class ConsoleLogger(QObject):
-    logUpdater = pyqtSignal(str)
+    "Emits log events of the protocol to the widget"
+    logUpdater = pyqtSignal(object)
 
     def __init__(self):
         QObject.__init__(self)
 
     def send(self, message):
-        self.logUpdater.emit(str(message))
+        self.logUpdater.emit(LogEvent.of(message))
 
     def put(self, message):
         self.send(message)
@@ -0,0 +1,554 @@
+"""
+Benchmarks for the hot paths of the CashShuffle protocol.
+
+Run it from the electron-cash root directory:
+
+    python3 plugins/shuffle/tests/benchmark.py [benchmark_name ...]
+
+Results are compared with the baselines of benchmark_baselines.json:
+
+    --save       stores the results of the run as the new baselines
+    --check      exits with non-zero status if some result is slower
+                 than its baseline by more than the threshold, if the
+                 baselines file is missing or if a result has no baseline
+    --threshold  allowed slowdown, 0.25 means 25% (default)
+    --large      adds the pools of 100 and 200 players to simulated_round,
+                 they run for many minutes and are left out by default
+
+Every benchmark is repeated and the best time is taken. The spread of the
+repeats is the noise of the benchmark, it is stored with the baseline and
+added to the threshold of that benchmark, so short and jittery benchmarks
+do not fail the check on timer noise. A failed benchmark is reported and
+the run goes on with the next one.
+
+Baselines depend on the machine, so record them with --save on the machine
+which runs the check, in the full Electron Cash environment.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import traceback
+from electroncash_plugins.shuffle.crypto import Crypto, EquivocationHash
+from electroncash_plugins.shuffle.messages import Messages
+from electroncash_plugins.shuffle.coin import Coin, UnspentCache, SighashContext
+from electroncash_plugins.shuffle.commutator_thread import Channel
+from electroncash_plugins.shuffle.coin_shuffle import Round, PlayerRing, PhaseInbox
+from electroncash_plugins.shuffle.phase import PhaseType
+from electrum_server import ElectrumServer, ElectrumClient
+from simulator import Simulation
+from electroncash.bitcoin import public_key_to_p2pkh, Hash, bfh
+
+class Timing(float):
+    """
+    Best wall time of the benchmark in seconds. noise is the relative spread
+    of the repeats, (median - best) / best, None for the single run
+    """
+    def __new__(cls, seconds, noise=None):
+        timing = float.__new__(cls, seconds)
+        timing.noise = noise
+        return timing
+
+def best_of(func, repeat=5):
+    "returns the best wall time of func with the noise of the repeats"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    best = times[0]
+    if repeat == 1 or best <= 0:
+        return Timing(best)
+    return Timing(best, (times[len(times) // 2] - best) / best)
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# results of the run {'name/size': seconds}
+RESULTS = {}
+# relative noise of the results {'name/size': spread}
+NOISE = {}
+# pool sizes of simulated_round run only with --large
+LARGE_SIZES = ()
+
+def report(name, size, seconds):
+    key = name + '/' + str(size)
+    RESULTS[key] = float(seconds)
+    noise = getattr(seconds, 'noise', None)
+    if noise is None:
+        print("{:<40} {:>5} {:>12.3f} ms".format(name, size, seconds * 1000))
+    else:
+        NOISE[key] = noise
+        print("{:<40} {:>5} {:>12.3f} ms  +-{:.0%}".format(name, size, seconds * 1000, noise))
+
+def load_baselines(path=BASELINES):
+    try:
+        with open(path) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {'machine': None, 'results': {}}
+    baselines.setdefault('noise', {})
+    return baselines
+
+def save_baselines(results, noise, path=BASELINES):
+    "merges the results and their noise into the baselines file"
+    baselines = load_baselines(path)
+    baselines['machine'] = {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'processor': platform.processor()}
+    baselines['results'].update(results)
+    for key in results:
+        if key in noise:
+            baselines['noise'][key] = noise[key]
+        else:
+            baselines['noise'].pop(key, None)
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def regressions(results, baselines, threshold, noise=None):
+    """
+    returns [(key, baseline, result)] of results slower than baseline by more than threshold.
+    The larger noise of the baseline and of the run is added to the threshold of the benchmark
+    """
+    noise = noise or {}
+    slower = []
+    for key in sorted(results):
+        baseline = baselines['results'].get(key)
+        if not baseline:
+            continue
+        floor = max(baselines.get('noise', {}).get(key) or 0, noise.get(key) or 0)
+        if results[key] > baseline * (1 + threshold + floor):
+            slower.append((key, baseline, results[key]))
+    return slower
+
+class SlowNetwork(object):
+    "stand-in for the Electrum server with the fixed round trip time"
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.coins = {}
+
+    def synchronous_get(self, command):
+        time.sleep(self.rtt)
+        bc_command, params = command
+        if bc_command == 'blockchain.address.listunspent':
+            return self.coins.get(params[0], [])
+        return []
+
+def make_transaction(number_of_inputs, amount=1000, fee=100):
+    """
+    Makes unsigned shuffle transaction spending coins of random keys.
+    Returns coin, transaction and dict of keys by verification key
+    """
+    network = SlowNetwork(0)
+    coin = Coin(network, cache=UnspentCache())
+    keys = {}
+    inputs = {}
+    for _ in range(number_of_inputs):
+        crypto = Crypto()
+        crypto.generate_key_pair()
+        verification_key = crypto.eck.get_public_key(True)
+        keys[verification_key] = crypto.eck
+        inputs[verification_key] = coin.address(verification_key)
+        network.coins[inputs[verification_key]] = [{"height": 0,
+                                                    "value": amount + fee + 5000,
+                                                    "tx_pos": 0,
+                                                    "tx_hash": bytes.hex(os.urandom(32))}]
+    outputs = [public_key_to_p2pkh(bytes.fromhex(key)) for key in random.sample(list(keys), len(keys))]
+    transaction = coin.make_unsigned_transaction(amount, fee, inputs, outputs, inputs)
+    return coin, transaction, keys
+
+def make_shuffle_blame_round(number_of_players, cheat):
+    """
+    Builds the Round with complete 'Shuffle and Equivocation Failure' blame inbox.
+    The cheater behaves like Round_wrong_ciphertexts ('ciphertexts')
+    or like Round_wrong_outputs ('outputs') from test.py
+    """
+    numbers = list(range(1, number_of_players + 1))
+    cryptos = {}
+    for number in numbers:
+        cryptos[number] = Crypto()
+        cryptos[number].generate_key_pair()
+    players = {number: cryptos[number].export_public_key() for number in numbers}
+    addresses = {number: public_key_to_p2pkh(bytes.fromhex(players[number])) for number in numbers}
+    cheater = random.choice(numbers[1:-1])
+
+    def onion(number, address):
+        encrypted = address
+        for i in reversed(numbers[numbers.index(number) + 1:]):
+            encrypted = cryptos[number].encrypt(encrypted, cryptos[i].export_public_key())
+        return encrypted
+
+    received = {numbers[0]: []}
+    strs = [onion(numbers[0], addresses[numbers[0]])]
+    for number in numbers[1:-1]:
+        received[number] = list(strs)
+        strs = [cryptos[number].decrypt(s).decode('utf-8') for s in strs]
+        if number == cheater:
+            address = addresses[number] if cheat == 'ciphertexts' else addresses[numbers[0]]
+            strs[random.randint(0, len(strs) - 1)] = onion(number, address)
+        strs.append(onion(number, addresses[number]))
+        random.shuffle(strs)
+    received[numbers[-1]] = list(strs)
+
+    protocol = Round(None, Crypto(), Messages(), Channel(), Channel(), Channel(),
+                     b'session', 'Blame', 1000, 100, None, players[numbers[0]],
+                     players, addresses[numbers[0]], addresses[numbers[0]])
+    phase_blame = protocol.messages.phases["Blame"]
+    for number in numbers:
+        phase2 = Messages()
+        for s in received[number]:
+            phase2.add_str(s)
+        blame = Messages()
+        blame.blame_shuffle_and_equivocation_failure(players[cheater],
+                                                     cryptos[number].export_public_key(),
+                                                     cryptos[number].export_private_key(),
+                                                     phase2.packets.SerializeToString())
+        protocol.inbox[phase_blame][players[number]] = blame.packets.SerializeToString()
+    return protocol, players[cheater]
+
+def bench_messages(sizes=(5, 20, 100)):
+    "signing and encoding of the packets with new addresses, decoding of them"
+    crypto = Crypto()
+    crypto.generate_key_pair()
+    verification_key = crypto.eck.get_public_key(True)
+    for size in sizes:
+        addresses = [public_key_to_p2pkh(bytes.fromhex(verification_key)) for _ in range(size)]
+
+        def encode():
+            messages = Messages()
+            for address in addresses:
+                messages.add_str(address)
+            messages.form_all_packets(crypto.eck, b'session', 1, verification_key, None, 'Shuffling')
+            return messages.packets.SerializeToString()
+
+        frame = encode()
+
+        def decode():
+            messages = Messages()
+            messages.packets.ParseFromString(frame)
+            messages.get_strs()
+
+        report('messages[encode]', size, best_of(encode))
+        report('messages[decode]', size, best_of(lambda: [decode() for _ in range(100)]) / 100)
+
+def bench_crypto(sizes=(1, 10)):
+    "ECIES encryption and decryption of the new address"
+    sender, receiver = Crypto(), Crypto()
+    sender.generate_key_pair()
+    receiver.generate_key_pair()
+    address = public_key_to_p2pkh(bytes.fromhex(receiver.export_public_key()))
+    for size in sizes:
+        ciphertexts = [sender.encrypt(address, receiver.export_public_key()) for _ in range(size)]
+        report('crypto[encrypt]', size,
+               best_of(lambda: [sender.encrypt(address, receiver.export_public_key())
+                                for _ in range(size)]))
+        report('crypto[decrypt]', size,
+               best_of(lambda: [receiver.decrypt(ciphertext) for ciphertext in ciphertexts]))
+
+def bench_verify_signature(sizes=(1, 10)):
+    "Coin.verify_signature of the packet signatures"
+    crypto = Crypto()
+    crypto.generate_key_pair()
+    verification_key = crypto.eck.get_public_key(True)
+    message = os.urandom(200)
+    signature = crypto.eck.sign_message(message, True)
+    for size in sizes:
+        coin = Coin(None)
+        report('verify_signature', size,
+               best_of(lambda: [coin.verify_signature(signature, message, verification_key)
+                                for _ in range(size)]))
+
+def bench_verify_tx_signature(sizes=(5, 20, 50)):
+    "Coin.verify_tx_signature of the single input of transaction with size inputs"
+    for size in sizes:
+        coin, transaction, keys = make_transaction(size)
+        key = next(iter(keys))
+        signature = coin.get_transaction_signature(transaction, keys[key], key)
+        report('verify_tx_signature', size,
+               best_of(lambda: Coin(coin.network).verify_tx_signature(signature, transaction, key)))
+
+def bench_make_unsigned_transaction(sizes=(5, 20, 50, 100)):
+    "making of the unsigned shuffle transaction, unspent outputs are cached"
+    for size in sizes:
+        coin, _, keys = make_transaction(size)
+        inputs = {key: coin.address(key) for key in keys}
+        outputs = [public_key_to_p2pkh(bytes.fromhex(key)) for key in keys]
+        report('make_unsigned_transaction', size,
+               best_of(lambda: coin.make_unsigned_transaction(1000, 100, inputs, outputs, inputs)))
+
+def bench_check_for_shuffling(sizes=(5, 10, 20)):
+    "Round.check_for_shuffling with the cheater classes of test.py"
+    for cheat in ['ciphertexts', 'outputs']:
+        for size in sizes:
+            protocol, cheater = make_shuffle_blame_round(size, cheat)
+            assert protocol.check_for_shuffling() == cheater
+            report('check_for_shuffling[' + cheat + ']', size,
+                   best_of(protocol.check_for_shuffling))
+
+def bench_equivocation_hash(sizes=(10, 100, 1000)):
+    "equivocation hash of encryption keys and new addresses for large pools"
+    for size in sizes:
+        keys = [bytes.hex(b'\x02' + os.urandom(32)) for _ in range(size)]
+        addresses = [bytes.hex(os.urandom(17)) for _ in range(size)]
+        for version, name in [(EquivocationHash.LEGACY, 'legacy'),
+                              (EquivocationHash.CANONICAL, 'canonical')]:
+            def compute():
+                equivocation = EquivocationHash(version=version)
+                for key in keys:
+                    equivocation.add_key(key)
+                equivocation.add_addresses(addresses)
+                equivocation.digest(version)
+            report('equivocation_hash[' + name + ']', size, best_of(compute, repeat=10))
+
+def bench_listunspent(sizes=(5, 20, 50), rtt=0.05):
+    "funds check for all pool members, serial requests against batched ones"
+    for size in sizes:
+        network = SlowNetwork(rtt)
+        addresses = [bytes.hex(os.urandom(17)) for _ in range(size)]
+        for address in addresses:
+            network.coins[address] = [{"height": 0, "value": 5000, "tx_pos": 0, "tx_hash": ''}]
+
+        def serial():
+            coin = Coin(network, cache=UnspentCache())
+            for address in addresses:
+                coin.sufficient_funds(address, 1000)
+
+        def batched():
+            Coin(network, cache=UnspentCache()).sufficient_funds_batch(addresses, 1000)
+
+        report('listunspent[serial, rtt=' + str(rtt) + ']', size, best_of(serial, repeat=1))
+        report('listunspent[batched, rtt=' + str(rtt) + ']', size, best_of(batched))
+
+def bench_sighash(sizes=(5, 20, 50, 100, 200)):
+    "signature hashes of all inputs, full preimages against the shared sighash context"
+    for size in sizes:
+        _, transaction, _ = make_transaction(size)
+        inputs = range(len(transaction.inputs()))
+
+        def full():
+            for i in inputs:
+                Hash(bfh(transaction.serialize_preimage(i)))
+
+        def context():
+            sighash = SighashContext(transaction)
+            for i in inputs:
+                sighash.digest(i)
+
+        report('sighash[full preimage]', size, best_of(full, repeat=1))
+        report('sighash[context]', size, best_of(context))
+
+def bench_verification(sizes=(5, 20, 50)):
+    "VerificationAndSubmission: verification of transaction signatures of all players"
+    for size in sizes:
+        coin, transaction, keys = make_transaction(size)
+        signatures = {key: coin.get_transaction_signature(transaction, keys[key], key)
+                      for key in keys}
+
+        def verify():
+            assert not Coin(coin.network).verify_tx_signatures(signatures, transaction)
+
+        report('verify_tx_signatures', size, best_of(verify))
+
+def bench_add_signatures(sizes=(10, 50, 100, 500)):
+    "assembling of signed transaction from signatures of all players"
+    for size in sizes:
+        coin, transaction, keys = make_transaction(size)
+        signatures = {key: coin.get_transaction_signature(transaction, keys[key], key)
+                      for key in keys}
+        report('add_transaction_signatures', size,
+               best_of(lambda: coin.add_transaction_signatures(transaction, signatures)))
+
+def bench_dispatch(frames=10000, size=5):
+    "per frame dispatch of Round.process_inbox, the handlers do nothing"
+    players = {number: bytes.hex(b'\x02' + os.urandom(32)) for number in range(1, size + 1)}
+    protocol = Round(None, Crypto(), Messages(), Channel(), Channel(), Channel(),
+                     b'session', 'Announcement', 1000, 100, None, players[1],
+                     players, 'address', 'address')
+
+    def noop():
+        pass
+
+    for name in Round.HANDLERS.values():
+        setattr(protocol, name, noop)
+    protocol.handlers = {state: noop for state in protocol.handlers}
+
+    def legacy():
+        # the loop before the state machine: the table is made for every frame
+        for _ in range(frames):
+            if protocol.check_for_blame():
+                protocol.process_blame()
+            else:
+                {'Announcement' : protocol.process_announcement,
+                 'Shuffling' : protocol.process_shuffling,
+                 'BroadcastOutput' : protocol.process_broadcast_output,
+                 'EquivocationCheck' : protocol.process_equivocation_check,
+                 'VerificationAndSubmission' : protocol.process_verification_and_submission,
+                 'Blame' : protocol.process_blame
+                }[protocol.phase]()
+
+    def state_machine():
+        for _ in range(frames):
+            protocol.frame_phase = PhaseType.Announcement
+            protocol.process_inbox()
+
+    report('dispatch[legacy]', frames, best_of(legacy))
+    report('dispatch[state machine]', frames, best_of(state_machine))
+
+def bench_inbox(sizes=(5, 20, 100)):
+    """
+    filling of the phase inbox with the completion check after every frame.
+    Both take the sender check of Round.inchan_to_inbox: the dict checks the key
+    is a player, the PhaseInbox gets the position of the player with the same lookup
+    """
+    for size in sizes:
+        players = {number: bytes.hex(b'\x02' + os.urandom(32)) for number in range(1, size + 1)}
+        frames = [(key, os.urandom(200)) for key in players.values()]
+        ring = PlayerRing(players)
+
+        def fill_dict():
+            inbox = {}
+            for key, frame in frames:
+                if key in ring.numbers:
+                    inbox[key] = frame
+                len(inbox) == size
+
+        def fill_phase_inbox():
+            inbox = PhaseInbox(ring)
+            for key, frame in frames:
+                position = ring.places.get(key)
+                if position is not None:
+                    inbox.add(position, frame)
+                inbox.is_complete()
+
+        report('inbox[dict]', size, best_of(lambda: [fill_dict() for _ in range(100)]))
+        report('inbox[PhaseInbox]', size, best_of(lambda: [fill_phase_inbox() for _ in range(100)]))
+
+def bench_round_latency(rtts=(0, 0.02, 0.05, 0.1), size=5, jitter=0.2):
+    """
+    blockchain path of the round against the local Electrum server:
+    funds check, transaction assembling, signing and broadcasting.
+    Jitter is the fraction of rtt
+    """
+    amount, fee = 1000, 100
+    for rtt in rtts:
+        server = ElectrumServer(latency=rtt / 2, jitter=rtt * jitter / 2, seed=1).start()
+        client = ElectrumClient(server.host, server.port)
+        keys = {}
+        for _ in range(size):
+            crypto = Crypto()
+            crypto.generate_key_pair()
+            keys[crypto.eck.get_public_key(True)] = crypto.eck
+
+        def one_round():
+            coin = Coin(client, cache=UnspentCache())
+            inputs = {key: coin.address(key) for key in keys}
+            for address in inputs.values():
+                server.add_coin(address, amount + fee + 5000)
+            outputs = [public_key_to_p2pkh(bytes.fromhex(key))
+                       for key in random.sample(list(keys), len(keys))]
+            assert all(coin.sufficient_funds_batch(inputs.values(), amount + fee).values())
+            skeleton = coin.make_transaction_skeleton(amount, fee, inputs, inputs)
+            transaction = coin.complete_transaction(skeleton, amount, outputs)
+            signatures = {key: coin.get_transaction_signature(transaction, keys[key], key)
+                          for key in keys}
+            coin.add_transaction_signatures(transaction, signatures)
+            assert coin.broadcast_transaction(transaction)[0]
+
+        report('round_latency[rtt=' + str(rtt) + ']', size, best_of(one_round))
+        client.close()
+        server.stop()
+
+def bench_simulated_round(sizes=(3, 5, 10, 20, 50)):
+    """
+    protocol_loop of all players end to end in the in-process simulator.
+    Large pools of --large run for minutes, so their timeout grows with the pool size
+    """
+    for size in sizes + LARGE_SIZES:
+        def simulate():
+            simulation = Simulation(size, seed=size, timeout=max(120, size * 5))
+            assert simulation.run()
+            assert len(set(simulation.transactions().values())) == 1
+        report('simulated_round', size, best_of(simulate, repeat=1))
+
+def bench_op_counts(sizes=(3, 5, 10, 20)):
+    """
+    operations made by the busiest player in every phase of the simulated round.
+    Counts are exact, so the growth with the pool size shows the complexity of phases
+    """
+    for size in sizes:
+        simulation = Simulation(size, seed=size, count_ops=True)
+        assert simulation.run()
+        phases = {}
+        for protocol in simulation.rounds.values():
+            for phase, counts in protocol.counters.summary().items():
+                for op, n in counts.items():
+                    key = (str(phase), op)
+                    phases[key] = max(phases.get(key, 0), n)
+        for phase, op in sorted(phases):
+            print("{:<40} {:>5} {:>12}".format('ops[' + phase + '] ' + op, size, phases[phase, op]))
+
+BENCHMARKS = {
+    'messages': bench_messages,
+    'crypto': bench_crypto,
+    'verify_signature': bench_verify_signature,
+    'verify_tx_signature': bench_verify_tx_signature,
+    'make_unsigned_transaction': bench_make_unsigned_transaction,
+    'check_for_shuffling': bench_check_for_shuffling,
+    'equivocation_hash': bench_equivocation_hash,
+    'listunspent': bench_listunspent,
+    'sighash': bench_sighash,
+    'verification': bench_verification,
+    'add_signatures': bench_add_signatures,
+    'round_latency': bench_round_latency,
+    'dispatch': bench_dispatch,
+    'inbox': bench_inbox,
+    'simulated_round': bench_simulated_round,
+    'op_counts': bench_op_counts,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="CashShuffle benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default all)")
+    parser.add_argument("--save", action="store_true", help="store results as baselines")
+    parser.add_argument("--check", action="store_true", help="fail on regressions")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown")
+    parser.add_argument("--baselines", default=BASELINES, help="baselines file")
+    parser.add_argument("--large", action="store_true",
+                        help="simulate pools of 100 and 200 players too")
+    args = parser.parse_args()
+    if args.large:
+        global LARGE_SIZES
+        LARGE_SIZES = (100, 200)
+    failed = []
+    for name in args.names or sorted(BENCHMARKS):
+        try:
+            BENCHMARKS[name]()
+        except Exception:
+            # results reported before the failure are kept
+            traceback.print_exc()
+            failed.append(name)
+    for name in failed:
+        print("FAILED", name)
+    if args.save:
+        save_baselines(RESULTS, NOISE, args.baselines)
+    if args.check:
+        if not os.path.exists(args.baselines):
+            print("NO BASELINES FILE", args.baselines)
+            return 1
+        baselines = load_baselines(args.baselines)
+        slower = regressions(RESULTS, baselines, args.threshold, NOISE)
+        for key, baseline, result in slower:
+            print("REGRESSION {:<40} {:>12.3f} ms -> {:>12.3f} ms".format(key, baseline * 1000,
+                                                                        result * 1000))
+        missing = sorted(set(RESULTS) - set(baselines['results']))
+        for key in missing:
+            print("NO BASELINE", key)
+        return 1 if slower or missing or failed else 0
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
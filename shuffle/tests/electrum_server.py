@@ -0,0 +1,299 @@
+"""
+Local stand-in for the Electrum server.
+
+It speaks newline delimited JSON-RPC over TCP, like the real server, and
+implements the methods used by the plugin:
+
+    blockchain.address.listunspent
+    blockchain.address.subscribe
+    blockchain.transaction.broadcast
+    blockchain.transaction.get
+    server.version, server.ping
+
+UTXO sets are scripted with add_coin/spend_coin. Every response is delayed by
+latency plus random jitter, and fails with error_rate probability, so Coin and
+Round can be measured against something closer to the real network than
+testNetwork of test.py. ElectrumClient is the network object for Coin.
+"""
+import json
+import time
+import random
+import socket
+import hashlib
+import threading
+import socketserver
+
+
+class ElectrumServer(object):
+    "threaded TCP JSON-RPC server with scripted unspent outputs"
+
+    def __init__(self, host='localhost', port=0, latency=0, jitter=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.coins = {}
+        self.mempool = {}
+        self.subscriptions = {}
+        self.requests = 0
+        self.errors = 0
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.serve_connection(self.rfile, self.wfile)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # scripted chain state
+
+    def add_coin(self, address, value, height=0, tx_pos=0, tx_hash=None):
+        "adds unspent output to address and notifies subscribers"
+        if tx_hash is None:
+            tx_hash = bytes.hex(bytes(self.random.getrandbits(8) for _ in range(32)))
+        with self.lock:
+            self.coins.setdefault(address, []).append({"height": height, "value": value,
+                                                       "tx_pos": tx_pos, "tx_hash": tx_hash})
+        self.notify(address)
+        return tx_hash
+
+    def spend_coin(self, address, tx_hash, tx_pos):
+        "removes unspent output from address and notifies subscribers"
+        with self.lock:
+            coins = self.coins.get(address, [])
+            self.coins[address] = [coin for coin in coins
+                                   if (coin['tx_hash'], coin['tx_pos']) != (tx_hash, tx_pos)]
+            changed = len(coins) != len(self.coins[address])
+        if changed:
+            self.notify(address)
+        return changed
+
+    def status(self, address):
+        "address status in the Electrum manner, None for addresses without history"
+        with self.lock:
+            coins = self.coins.get(address)
+            if not coins:
+                return None
+            history = ''.join('{}:{}:'.format(coin['tx_hash'], coin['height']) for coin in coins)
+        return hashlib.sha256(history.encode('utf-8')).hexdigest()
+
+    def notify(self, address):
+        status = self.status(address)
+        with self.lock:
+            writers = list(self.subscriptions.get(address, []))
+        for writer in writers:
+            writer({"jsonrpc": "2.0",
+                    "method": "blockchain.address.subscribe",
+                    "params": [address, status]})
+
+    # protocol
+
+    def serve_connection(self, rfile, wfile):
+        write_lock = threading.Lock()
+
+        def write(response):
+            data = (json.dumps(response) + '\n').encode('utf-8')
+            with write_lock:
+                try:
+                    wfile.write(data)
+                    wfile.flush()
+                except (OSError, ValueError):
+                    pass
+
+        try:
+            for line in rfile:
+                if not line.strip():
+                    continue
+                request = json.loads(line.decode('utf-8'))
+                threading.Thread(target=self.respond, args=(request, write), daemon=True).start()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                for writers in self.subscriptions.values():
+                    if write in writers:
+                        writers.remove(write)
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+            failed = self.random.random() < self.error_rate
+        time.sleep(max(0, self.latency + jitter))
+        return failed
+
+    def respond(self, request, write):
+        failed = self.delay()
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        with self.lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+        if failed:
+            response["error"] = {"code": -32603, "message": "injected error"}
+        else:
+            try:
+                response["result"] = self.call(request.get("method"), request.get("params", []), write)
+            except Exception as e:
+                response["error"] = {"code": 1, "message": str(e)}
+        write(response)
+
+    def call(self, method, params, write):
+        if method == 'server.version':
+            return ['ElectrumServer stand-in', '1.2']
+        if method == 'server.ping':
+            return None
+        if method == 'blockchain.address.listunspent':
+            with self.lock:
+                return list(self.coins.get(params[0], []))
+        if method == 'blockchain.address.subscribe':
+            with self.lock:
+                writers = self.subscriptions.setdefault(params[0], [])
+                if write not in writers:
+                    writers.append(write)
+            return self.status(params[0])
+        if method == 'blockchain.transaction.broadcast':
+            return self.broadcast(params[0])
+        if method == 'blockchain.transaction.get':
+            with self.lock:
+                if params[0] not in self.mempool:
+                    raise Exception('No such mempool or blockchain transaction')
+                return self.mempool[params[0]]
+        raise Exception('unknown method ' + str(method))
+
+    def broadcast(self, raw):
+        "accepts raw transaction to the mempool, the same transaction is rejected the next time"
+        txid = bytes.hex(hashlib.sha256(hashlib.sha256(bytes.fromhex(raw)).digest()).digest()[::-1])
+        with self.lock:
+            if txid in self.mempool:
+                raise Exception('the transaction was rejected by network rules.\n\ntxn-already-in-mempool')
+            self.mempool[txid] = raw
+        self.spend_inputs(raw)
+        return txid
+
+    def spend_inputs(self, raw):
+        "spends the coins of the transaction inputs, so subscribers see them disappear"
+        try:
+            from electroncash.transaction import Transaction
+            inputs = Transaction(raw).inputs()
+        except Exception:
+            return
+        for txin in inputs:
+            with self.lock:
+                addresses = [address for address in self.coins
+                             if any(coin['tx_hash'] == txin.get('prevout_hash') and
+                                    coin['tx_pos'] == txin.get('prevout_n')
+                                    for coin in self.coins[address])]
+            for address in addresses:
+                self.spend_coin(address, txin.get('prevout_hash'), txin.get('prevout_n'))
+
+
+class ElectrumClient(object):
+    """
+    Network object for Coin talking to ElectrumServer.
+    It implements synchronous_get, send and broadcast of electroncash Network
+    """
+
+    def __init__(self, host, port, timeout=30):
+        self.timeout = timeout
+        self.socket = socket.create_connection((host, port))
+        self.rfile = self.socket.makefile('rb')
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}
+        self.callbacks = {}
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def read_loop(self):
+        try:
+            for line in self.rfile:
+                self.dispatch(json.loads(line.decode('utf-8')))
+        except (OSError, ValueError):
+            pass
+
+    def dispatch(self, response):
+        if response.get('id') is None:
+            # notification
+            with self.lock:
+                callbacks = list(self.callbacks.get(response.get('method'), []))
+            for callback in callbacks:
+                callback(response)
+            return
+        with self.lock:
+            request = self.pending.pop(response['id'], None)
+        if request is None:
+            return
+        method, params, event, callback = request
+        response['method'] = method
+        response['params'] = params
+        if event is not None:
+            event.response = response
+            event.set()
+        if callback is not None:
+            callback(response)
+
+    def request(self, method, params, event=None, callback=None):
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = (method, params, event, callback)
+            if callback is not None and method.endswith('.subscribe'):
+                callbacks = self.callbacks.setdefault(method, [])
+                if callback not in callbacks:
+                    callbacks.append(callback)
+            data = json.dumps({"jsonrpc": "2.0", "id": request_id,
+                               "method": method, "params": params}) + '\n'
+            self.socket.sendall(data.encode('utf-8'))
+
+    def synchronous_get(self, request, timeout=None):
+        method, params = request
+        event = threading.Event()
+        self.request(method, params, event=event)
+        if not event.wait(self.timeout if timeout is None else timeout):
+            raise Exception('Server did not answer')
+        response = event.response
+        if response.get('error'):
+            raise Exception(response['error'])
+        return response.get('result')
+
+    def send(self, messages, callback):
+        for method, params in messages:
+            self.request(method, params, callback=callback)
+
+    def unsubscribe(self, callback):
+        "drops the callback of notifications, as Network.unsubscribe does"
+        with self.lock:
+            for callbacks in self.callbacks.values():
+                if callback in callbacks:
+                    callbacks.remove(callback)
+
+    def broadcast(self, transaction, timeout=30):
+        try:
+            txid = self.synchronous_get(('blockchain.transaction.broadcast', [str(transaction)]),
+                                        timeout)
+        except Exception as e:
+            return False, str(e)
+        return True, txid
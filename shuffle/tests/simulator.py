@@ -0,0 +1,226 @@
+"""
+In-process simulator of the CashShuffle round.
+
+Simulation runs N Round instances in threads of one process. They are wired by
+Switch, which routes frames like the CashShuffle server does: frames with the
+receiver key go to this player only, other frames are broadcasted to all of the
+players including the sender, and LIAR blames are the ban votes for the server.
+Coins live in SimulatedNetwork, so the real Coin code is used without Electrum.
+
+Player keys, coins, addresses and shufflings come from the seeded random
+generator, so the course of the round is repeatable for the same seed.
+Cheaters of test.py are plugged with round_classes and crypto_classes.
+With count_ops every player counts its cryptographic and serialization work.
+"""
+import time
+import random
+import hashlib
+import threading
+from electroncash.bitcoin import EC_KEY, generator_secp256k1, public_key_to_p2pkh
+from ecdsa.util import number_to_string
+from electroncash_plugins.shuffle import message_pb2
+from electroncash_plugins.shuffle.coin import Coin, UnspentCache
+from electroncash_plugins.shuffle.crypto import Crypto
+from electroncash_plugins.shuffle.messages import Messages
+from electroncash_plugins.shuffle.commutator_thread import Channel
+from electroncash_plugins.shuffle.coin_shuffle import Round
+from electroncash_plugins.shuffle.tracing import OpCounters
+
+
+class SimulatedNetwork(object):
+    "blockchain of the simulation with generated unspent outputs"
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.coins = {}
+        self.mempool = {}
+        self.requests = 0
+
+    def add_coin(self, address, value, height=0, tx_pos=0):
+        tx_hash = bytes.hex(bytes(self.rng.getrandbits(8) for _ in range(32)))
+        self.coins.setdefault(address, []).append({"height": height, "value": value,
+                                                   "tx_pos": tx_pos, "tx_hash": tx_hash})
+
+    def synchronous_get(self, command, timeout=None):
+        bc_command, params = command
+        with self.lock:
+            self.requests += 1
+            if bc_command == 'blockchain.address.listunspent':
+                return list(self.coins.get(params[0], []))
+            if bc_command == 'blockchain.transaction.get':
+                if params[0] not in self.mempool:
+                    raise Exception('No such mempool or blockchain transaction')
+                return self.mempool[params[0]]
+        return []
+
+    def broadcast(self, transaction, timeout=None):
+        raw = str(transaction)
+        txid = bytes.hex(hashlib.sha256(hashlib.sha256(bytes.fromhex(raw)).digest()).digest()[::-1])
+        with self.lock:
+            if txid in self.mempool:
+                return False, 'txn-already-in-mempool'
+            self.mempool[txid] = raw
+        return True, txid
+
+
+class SwitchPort(object):
+    "outgoing channel of the player connected to the switch"
+
+    def __init__(self, switch):
+        self.switch = switch
+
+    def send(self, frame):
+        self.switch.route(frame)
+
+
+class Switch(object):
+    "routes the frames between the players like the CashShuffle server"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inchans = {}
+        self.banned = set()
+        self.votes = {}
+        self.frames = 0
+        self.bytes = 0
+
+    def connect(self, verification_key):
+        "returns incoming and outgoing channels for the player"
+        self.inchans[verification_key] = Channel()
+        return self.inchans[verification_key], SwitchPort(self)
+
+    def route(self, frame):
+        messages = Messages()
+        messages.packets.ParseFromString(frame)
+        from_key = messages.get_from_key()
+        to_key = messages.get_to_key()
+        with self.lock:
+            if from_key in self.banned:
+                return
+            self.frames += 1
+            self.bytes += len(frame)
+            if (messages.get_phase() == message_pb2.BLAME and
+                    messages.get_blame_reason() == message_pb2.LIAR):
+                self.vote(from_key, messages.get_accused_key())
+                return
+            receivers = [to_key] if to_key else list(self.inchans)
+            receivers = [key for key in receivers if key in self.inchans and key not in self.banned]
+        for key in receivers:
+            self.inchans[key].send(frame)
+
+    def vote(self, voter, accused):
+        "bans the accused player when the majority of the other players votes for it"
+        voters = self.votes.setdefault(accused, set())
+        voters.add(voter)
+        others = len([key for key in self.inchans if key not in self.banned and key != accused])
+        if len(voters) * 2 > others:
+            self.banned.add(accused)
+
+    def disconnect(self):
+        "wakes up all of the players waiting for frames"
+        for inchan in self.inchans.values():
+            inchan.send(None)
+
+
+class Simulation(object):
+    """
+    Simulation of the single CashShuffle round of number_of_players players.
+
+    round_classes and crypto_classes are dicts {player number: class} to replace
+    Round and Crypto of some players, e.g. with cheaters of test.py.
+    """
+
+    def __init__(self, number_of_players, seed=0, amount=1000, fee=100,
+                 round_classes=None, crypto_classes=None, timeout=120, tracer=None,
+                 count_ops=False):
+        self.number_of_players = number_of_players
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.amount = amount
+        self.fee = fee
+        self.round_classes = round_classes or {}
+        self.crypto_classes = crypto_classes or {}
+        self.timeout = timeout
+        self.tracer = tracer
+        self.count_ops = count_ops
+        self.network = SimulatedNetwork(self.rng)
+        self.switch = Switch()
+        self.rounds = {}
+        self.logs = {}
+        self.threads = []
+        self.elapsed = None
+
+    def make_key(self):
+        order = generator_secp256k1.order()
+        return EC_KEY(number_to_string(self.rng.randrange(1, order), order))
+
+    def make_address(self):
+        return public_key_to_p2pkh(bytes.fromhex(self.make_key().get_public_key(True)))
+
+    def setup(self):
+        "makes the players, their coins and rounds"
+        session = bytes(self.rng.getrandbits(8) for _ in range(32))
+        keys = {number: self.make_key() for number in range(1, self.number_of_players + 1)}
+        players = {number: keys[number].get_public_key(True) for number in keys}
+        for number in keys:
+            address = public_key_to_p2pkh(bytes.fromhex(players[number]))
+            self.network.add_coin(address, self.amount + self.fee + self.rng.randint(1, 1000))
+        for number in keys:
+            inchan, outchan = self.switch.connect(players[number])
+            self.logs[number] = Channel()
+            round_class = self.round_classes.get(number, Round)
+            crypto_class = self.crypto_classes.get(number, Crypto)
+            self.rounds[number] = round_class(Coin(self.network, cache=UnspentCache()),
+                                              crypto_class(), Messages(),
+                                              inchan, outchan, self.logs[number],
+                                              session, 'Announcement', self.amount, self.fee,
+                                              keys[number], players[number], dict(players),
+                                              self.make_address(), self.make_address(),
+                                              tracer=self.tracer,
+                                              counters=OpCounters() if self.count_ops else None)
+        return self
+
+    def run(self):
+        "runs the round, returns True if every player which is not banned is done in time"
+        if not self.rounds:
+            self.setup()
+        # shuffles of the packets are made by the global generator
+        random.seed(self.seed)
+        start = time.time()
+        self.threads = [threading.Thread(target=self.rounds[number].protocol_loop, daemon=True)
+                        for number in self.rounds]
+        for thread in self.threads:
+            thread.start()
+        deadline = start + self.timeout
+        threads = dict(zip(self.rounds, self.threads))
+        finished = False
+        while not finished and time.time() < deadline:
+            finished = not any(threads[number].is_alive() for number in threads
+                               if self.rounds[number].vk not in self.switch.banned)
+            if not finished:
+                time.sleep(0.01)
+        self.elapsed = time.time() - start
+        self.stop()
+        return finished
+
+    def stop(self):
+        "stops the rounds which still wait for frames"
+        for protocol in self.rounds.values():
+            if not protocol.done:
+                protocol.done = True
+        self.switch.disconnect()
+        for thread in self.threads:
+            thread.join(1)
+
+    def transactions(self):
+        "raw transactions of players which completed the protocol"
+        return {number: protocol.tx.raw for number, protocol in self.rounds.items()
+                if protocol.tx is not None}
+
+    def log(self, number):
+        "all of the log messages of the player"
+        messages = []
+        while not self.logs[number].empty():
+            messages.append(str(self.logs[number].get_nowait()))
+        return messages
@@ -513,7 +513,7 @@ class TestProtocolCase(unittest.TestCase):
     def get_last_logger_message(self, pThread, debug = False):
         message = None
         while not pThread.logger.empty():
-            message = pThread.logger.get()
+            message = str(pThread.logger.get())
             if debug:
                 print(message)
         return message
@@ -11,7 +11,7 @@ class TestProtocol(TestProtocolCase):
         message =''
         while not done:
             try:
-                message = protocolThread.logger.get_nowait()
+                message = str(protocolThread.logger.get_nowait())
                 done = message.startswith("Error")
             except:
                 pass
@@ -26,7 +26,7 @@ class TestProtocol(TestProtocolCase):
         message =''
         while not done:
             try:
-                message = protocolThread.logger.get_nowait()
+                message = str(protocolThread.logger.get_nowait())
                 done = message.startswith("Error")
             except:
                 pass
@@ -41,7 +41,7 @@ class TestProtocol(TestProtocolCase):
     #     message =''
     #     while not done:
     #         try:
-    #             message = protocolThread.logger.get_nowait()
+    #             message = str(protocolThread.logger.get_nowait())
     #             if message.endswith(" get session number.\n"):
     #                 protocolThread.done.set()
     #             done = message.startswith("Error")
@@ -60,7 +60,7 @@ class TestProtocol(TestProtocolCase):
         while not done:
             for pThread in protocolThreads:
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     if "is about to share verification key with" in message:
                         pThread.join()
                         # server.kill()
@@ -17,7 +17,7 @@ class TestProtocol(TestProtocolCase):
             # read protocol messages
             for pThread in protocolThreads:
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
                 except:
                     pass
@@ -54,7 +54,7 @@ class TestProtocolOnFault(TestProtocolCase):
             # read protocol messages
             for pThread in protocolThreads:
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
                     if message.startswith("Error"):
                         error_raised = True
@@ -67,7 +67,7 @@ class TestProtocolOnFault(TestProtocolCase):
         for pThread in protocolThreads:
             while not pThread.logger.empty():
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
                     if message.startswith("Error"):
                         error_raised = True
@@ -77,20 +77,34 @@ class TestProtocolOnFault(TestProtocolCase):
 
     def test_002_make_transaction_fault(self):
         protocolThreads = self.make_clients_threads()
+        # the skeleton is made in background during the shuffling,
+        # so the network of the faulty player fails right there
+        faulty = protocolThreads[0]
+        make_coin = faulty.make_coin
+        skeleton_requests = []
+        def make_faulty_coin():
+            coin = make_coin()
+            def make_transaction_skeleton(amount, fee, inputs, changes):
+                skeleton_requests.append(inputs)
+                return None
+            coin.make_transaction_skeleton = make_transaction_skeleton
+            return coin
+        faulty.make_coin = make_faulty_coin
         for pThread in protocolThreads:
             pThread.start()
         done = False
         error_raised = False
+        signatures_received = False
         while not done:
             # read protocol messages
             for pThread in protocolThreads:
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
-                    if message.startswith("Error"):
+                    if pThread is faulty and message.startswith("Error"):
                         error_raised = True
-                    if pThread.network != None and "encrypt " in message:
-                        pThread.protocol.coin.network = None
+                    if pThread is faulty and "got transction signatures" in message:
+                        signatures_received = True
                 except:
                     pass
             done = any([self.is_protocol_done(pThread) == True for pThread in protocolThreads])
@@ -100,13 +114,19 @@ class TestProtocolOnFault(TestProtocolCase):
         for pThread in protocolThreads:
             while not pThread.logger.empty():
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
-                    if message.startswith("Error"):
+                    if pThread is faulty and message.startswith("Error"):
                         error_raised = True
+                    if pThread is faulty and "got transction signatures" in message:
+                        signatures_received = True
                 except:
                     pass
+        self.assertTrue(skeleton_requests)
         self.assertTrue(error_raised)
+        # the round stops on the transaction, not on the broadcast
+        self.assertFalse(signatures_received)
+        self.assertIsNone(faulty.protocol.transaction)
 
     def test_003_broadcast_transaction_fault(self):
         protocolThreads = self.make_clients_threads()
@@ -118,7 +138,7 @@ class TestProtocolOnFault(TestProtocolCase):
             # read protocol messages
             for pThread in protocolThreads:
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
                     if message.startswith("Error"):
                         error_raised = True
@@ -133,7 +153,7 @@ class TestProtocolOnFault(TestProtocolCase):
         for pThread in protocolThreads:
             while not pThread.logger.empty():
                 try:
-                    message = pThread.logger.get_nowait()
+                    message = str(pThread.logger.get_nowait())
                     print(message)
                     if message.startswith("Error"):
                         error_raised = True
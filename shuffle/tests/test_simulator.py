@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+from test import Round_wrong_ciphertexts, Round_wrong_outputs
+from simulator import Simulation
+from electroncash_plugins.shuffle.coin import Coin
+
+class TestSimulatedProtocol(unittest.TestCase):
+
+    def assertSameTransaction(self, simulation, players):
+        transactions = simulation.transactions()
+        self.assertEqual(sorted(transactions), sorted(players))
+        self.assertEqual(len(set(transactions.values())), 1)
+
+    def test_001_correct_protocol(self):
+        simulation = Simulation(5, seed=1)
+        self.assertTrue(simulation.run())
+        self.assertSameTransaction(simulation, range(1, 6))
+
+    def test_002_same_seed_same_transaction(self):
+        first = Simulation(3, seed=2)
+        second = Simulation(3, seed=2)
+        self.assertTrue(first.run())
+        self.assertTrue(second.run())
+        self.assertEqual(first.transactions(), second.transactions())
+
+    def test_003_duplicated_ciphertexts(self):
+        simulation = Simulation(4, seed=3, round_classes={2: Round_wrong_ciphertexts})
+        self.assertTrue(simulation.run())
+        self.assertIn(simulation.rounds[2].vk, simulation.switch.banned)
+        self.assertSameTransaction(simulation, [1, 3, 4])
+
+    def test_004_changed_output(self):
+        simulation = Simulation(4, seed=4, round_classes={3: Round_wrong_outputs})
+        self.assertTrue(simulation.run())
+        self.assertIn(simulation.rounds[3].vk, simulation.switch.banned)
+        self.assertSameTransaction(simulation, [1, 2, 4])
+
+    def test_005_recovery_after_blame(self):
+        requests = {}
+        make_transaction_skeleton = Coin.make_transaction_skeleton
+
+        def recording(coin, amount, fee, inputs, changes):
+            requests.setdefault(id(coin), []).append(set(inputs))
+            return make_transaction_skeleton(coin, amount, fee, inputs, changes)
+
+        simulation = Simulation(4, seed=5, round_classes={2: Round_wrong_ciphertexts})
+        with mock.patch.object(Coin, 'make_transaction_skeleton', recording):
+            self.assertTrue(simulation.run())
+        cheater = simulation.rounds[2].vk
+        first_try = {protocol.vk for protocol in simulation.rounds.values()}
+        for number in [1, 3, 4]:
+            protocol = simulation.rounds[number]
+            self.assertEqual(protocol.excluded, {cheater})
+            self.assertIsNotNone(protocol.recovery_time)
+            self.assertIsNone(protocol.blame_started)
+            self.assertNotIn(cheater, protocol.skeleton_request[0])
+            # the next try reuses the skeleton of the failed one, so it is requested only once
+            self.assertEqual(requests[id(protocol.coin)], [first_try])
+
+    def test_006_operation_counts(self):
+        first = Simulation(4, seed=6, count_ops=True)
+        second = Simulation(4, seed=6, count_ops=True)
+        self.assertTrue(first.run())
+        self.assertTrue(second.run())
+        for number in first.rounds:
+            self.assertEqual(first.rounds[number].counters.summary(),
+                             second.rounds[number].counters.summary())
+        totals = [protocol.counters.totals() for protocol in first.rounds.values()]
+        # layered encryption: player i encrypts for the players after it, n(n-1)/2 in total
+        self.assertEqual(sum(total.get('ecies_encrypt', 0) for total in totals), 6)
+        self.assertEqual(sum(total.get('ecies_decrypt', 0) for total in totals), 6)
+        for total in totals:
+            # signatures of all players and the self check of the own one
+            self.assertEqual(total['ecdsa_verify'], 5)
@@ -0,0 +1,199 @@
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+class Tracer(object):
+    """
+    Collects structured events of the protocol rounds.
+
+    Events are dicts with the wall clock timestamp, the thread and the event
+    fields. They go to the in-memory ring of the last capacity events and,
+    if sink is set, to the file in JSON Lines format. Spans record the wall
+    and cpu (time.thread_time) durations and the name of the enclosing span,
+    so a single shuffle can be reconstructed as a timeline.
+    """
+    enabled = True
+
+    def __init__(self, capacity=10000, sink=None):
+        self.events = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sink = open(sink, 'a') if isinstance(sink, str) else sink
+
+    def emit(self, event, **fields):
+        "records the event"
+        record = {'ts': time.time(), 'thread': threading.current_thread().name, 'event': event}
+        record.update(fields)
+        with self.lock:
+            self.events.append(record)
+            if self.sink is not None:
+                self.sink.write(json.dumps(record, default=str) + '\n')
+                self.sink.flush()
+        return record
+
+    @contextmanager
+    def span(self, name, **fields):
+        "records the span event with durations of the enclosed block"
+        stack = self.local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start, cpu_start = time.time(), time.thread_time()
+        try:
+            yield
+        finally:
+            cpu = time.thread_time() - cpu_start
+            stack.pop()
+            self.emit('span', name=name, parent=parent, start=start,
+                      duration=time.time() - start, cpu=cpu, **fields)
+
+    def wrap(self, obj, prefix, fields=None):
+        """
+        returns the proxy of obj making the span for every method call.
+        Spans get the current content of fields dict
+        """
+        return TracedObject(obj, self, prefix, {} if fields is None else fields)
+
+    def timeline(self, **fields):
+        "returns the recorded events with the fields values in order of time"
+        with self.lock:
+            events = list(self.events)
+        events = [event for event in events
+                  if all(event.get(key) == value for key, value in fields.items())]
+        return sorted(events, key=lambda event: event.get('start', event['ts']))
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+class NullSpan(object):
+    "span which does nothing, it is shared to keep disabled tracing cheap"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class NullTracer(object):
+    "Tracer which records nothing, the default of Round"
+    enabled = False
+    null_span = NullSpan()
+
+    def emit(self, event, **fields):
+        return None
+
+    def span(self, name, **fields):
+        return self.null_span
+
+    def wrap(self, obj, prefix, fields=None):
+        return obj
+
+    def timeline(self, **fields):
+        return []
+
+    def close(self):
+        pass
+
+null_tracer = NullTracer()
+
+# point multiplications made by library operations, they are added to ec_mult counter
+EC_MULTS = {
+    'ecdsa_sign': 1,
+    'ecdsa_verify': 2,
+    'ecdsa_recover': 2,
+    'ecies_encrypt': 2,
+    'ecies_decrypt': 1,
+}
+
+class OpCounters(object):
+    """
+    Counters of cryptographic and serialization work of the round.
+
+    Operations are counted per phase, so the work of every phase can be
+    checked against the number of players. Counts depend only on the course
+    of the round, not on timings, so runs of the same round give the same
+    numbers and regressions show up as exact differences.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counts = {}
+        self.phase = None
+
+    def call_in_phase(self, phase, func, *args):
+        "calls func counting its operations to phase, it is used for the background work"
+        self.local.phase = phase
+        try:
+            return func(*args)
+        finally:
+            del self.local.phase
+
+    def count(self, op, n=1):
+        "adds n operations op to the current phase"
+        mults = EC_MULTS.get(op)
+        phase = getattr(self.local, 'phase', self.phase)
+        with self.lock:
+            key = (phase, op)
+            self.counts[key] = self.counts.get(key, 0) + n
+            if mults:
+                key = (phase, 'ec_mult')
+                self.counts[key] = self.counts.get(key, 0) + mults * n
+
+    def summary(self):
+        "returns counts as {phase: {op: n}}, work before the first phase goes to None"
+        summary = {}
+        with self.lock:
+            for (phase, op), n in self.counts.items():
+                summary.setdefault(phase, {})[op] = n
+        return summary
+
+    def totals(self):
+        "returns counts of all phases as {op: n}"
+        totals = {}
+        with self.lock:
+            for (phase, op), n in self.counts.items():
+                totals[op] = totals.get(op, 0) + n
+        return totals
+
+class NullCounters(object):
+    "Counters which count nothing, the default of Round"
+    enabled = False
+    phase = None
+
+    def count(self, op, n=1):
+        return None
+
+    def summary(self):
+        return {}
+
+    def totals(self):
+        return {}
+
+null_counters = NullCounters()
+
+class TracedObject(object):
+    "proxy which makes the span for every method call of the wrapped object"
+
+    def __init__(self, obj, tracer, prefix, fields):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_tracer', tracer)
+        object.__setattr__(self, '_prefix', prefix)
+        object.__setattr__(self, '_fields', fields)
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if not callable(value) or name.startswith('_'):
+            return value
+        tracer, span_name, fields = self._tracer, self._prefix + '.' + name, self._fields
+
+        def traced(*args, **kwargs):
+            with tracer.span(span_name, **fields):
+                return value(*args, **kwargs)
+        return traced
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)